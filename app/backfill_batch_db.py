@@ -1,11 +1,13 @@
-import json
 from datetime import datetime, timedelta
 
-import boto3
 import pandas as pd
 import yfinance as yf
 
-from utils import config, db_interface, twitter_interface
+from utils import archive_interface, config, db_interface, twitter_interface
+
+# Raw tweets are streamed to S3 while they are fetched, keeping memory bounded: "parquet" into the
+# partitioned Parquet archive with archive_interface.ParquetArchiveWriter, "ndjson" to one gzip NDJSON object per fetch date.
+RAW_ARCHIVE_FORMAT = "parquet"
 
 
 def backfill_stock_data(ticker: str, name: str) -> None:
@@ -22,6 +24,7 @@ def backfill_stock_data(ticker: str, name: str) -> None:
             table_name="stock_price",
             constraint_key="ticker, timestamp",
             curr=curr,
+            method="copy",
         )
 
 
@@ -38,7 +41,8 @@ def get_stock_prices(ticker: str) -> pd.DataFrame:
 
 
 def backfill_twitter_data(query: str, count: int) -> None:
-    """Backfill tweet table in the batch DB and raw tweets into S3 going back 7 days (Twitter API limit)."""
+    """Backfill tweet table (and its tweet_sentiment_daily rollup) in the batch DB and raw tweets into S3
+    going back 7 days (Twitter API limit)."""
 
     twitter = twitter_interface.TwitterConnection(config.get_twitter_creds())
 
@@ -46,32 +50,43 @@ def backfill_twitter_data(query: str, count: int) -> None:
     # Free version of the Twitter search API can only go back 7 days.
     for i in range(7, -1, -1):
         date = (datetime.now() - timedelta(days=i)).strftime("%Y-%m-%d")
-        tweets = twitter.get_tweets(query=query, count=count, until=date)
-        processed_tweets += tweets[0]
 
         # Insert raw tweets into data lake (hosted using AWS S3).
-        s3_bucket = "stock-twitter-s3"
-        s3_key = date + "_raw_tweets.json"
-        data = json.dumps(tweets[1])
-        upload_to_S3(s3_bucket, s3_key, data)
+        if RAW_ARCHIVE_FORMAT == "ndjson":
+            s3_bucket = "stock-twitter-s3"
+            s3_key = f"{query}/{date}_raw_tweets.ndjson.gz"
+            writer = archive_interface.NdjsonS3Writer(s3_bucket, s3_key)
+        else:
+            writer = archive_interface.ParquetArchiveWriter(keyword=query)
+        with writer:
+            tweets = twitter.get_tweets(
+                query=query,
+                count=count,
+                until=date,
+                sentiment_workers=None,
+                raw_tweet_sink=writer.write,
+            )
+
+        processed_tweets += tweets[0]
 
     # Insert processed tweets into the batch DB.
     with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
         db_interface.execute_json_upsert(
             json_data=processed_tweets,
             table_name="tweet",
-            constraint_key="twitter_id",
+            constraint_key="twitter_id, keyword",
             curr=curr,
+            method="copy",
         )
-
-
-def upload_to_S3(bucket: str, key: str, data: json) -> None:
-    """Upload data to S3."""
-
-    s3_client = boto3.client("s3")
-    s3_client.put_object(Body=data, Bucket=bucket, Key=key)
+        if processed_tweets:
+            days = [x["created_at"] for x in processed_tweets]
+            db_interface.refresh_tweet_sentiment_daily(
+                keyword=query, start_day=min(days), end_day=max(days), curr=curr
+            )
 
 
 if __name__ == "__main__":
-    backfill_stock_data(ticker="URA", name="Uranium ETF")
-    backfill_twitter_data(query="uranium", count=100)
+    for symbol in config.get_tracked_symbols():
+        backfill_stock_data(ticker=symbol.ticker, name=symbol.name)
+        backfill_twitter_data(query=symbol.keyword, count=100)
+    twitter_interface.shutdown_sentiment_pool()
@@ -1,63 +1,464 @@
+import argparse
 import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Callable, Dict, List
 
 from kafka import KafkaConsumer
+from kafka.structs import OffsetAndMetadata
 
-from utils import config, db_interface, twitter_interface
+from utils import config, db_interface, tweet_schema, twitter_interface
 
 TOPIC_NAME = "TWEET_STREAM"
 
-CONSUMER = KafkaConsumer(
-    TOPIC_NAME,
-    bootstrap_servers=["kafka:9093"],
-    auto_offset_reset="latest",
-    enable_auto_commit=True,
-    auto_commit_interval_ms=5000,
-    fetch_max_bytes=128,
-    max_poll_records=100,
-    value_deserializer=lambda x: json.loads(x.decode("utf-8")),
-)
+# Flush buffered tweets to the stream DB once either limit is reached.
+BATCH_MAX_ROWS = 500
+BATCH_MAX_MS = 1000
 
+# Sentiment cache is persisted here between consumer restarts, on exit and every SENTIMENT_CACHE_SAVE_INTERVAL_SECONDS
+# (so a killed worker loses at most one interval of scores).
+SENTIMENT_CACHE_PATH = "sentiment_cache.json"
+SENTIMENT_CACHE_SAVE_INTERVAL_SECONDS = 5 * 60
 
-def stream_tweets_consume() -> None:
-    """Consumer for the TWEET_STREAM Kafka topic. Loads consumed tweets into the stream DB."""
+# Fetch sizing. Raw tweets are several KB each, so fetch whole batches per round trip.
+FETCH_MIN_BYTES = 1
+FETCH_MAX_WAIT_MS = 500
+FETCH_MAX_BYTES = 16 * 1024 * 1024
+MAX_PARTITION_FETCH_BYTES = 2 * 1024 * 1024
+MAX_POLL_RECORDS = 500
 
-    for message in CONSUMER:
+# JSON backend used to decode payloads: "auto" picks the fastest one installed.
+JSON_BACKEND = "auto"
 
-        tweet = json.loads(json.dumps(message.value))
+# All consumer workers join this group, so Kafka assigns each one its own partitions.
+CONSUMER_GROUP_ID = "tweet_stream_consumer"
 
-        if tweet["retweeted"] or "RT @" in tweet["text"]:
-            continue
+# How often tweet_stream's upcoming daily partitions are created and expired ones dropped.
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = 60 * 60
 
-        if tweet["truncated"]:
-            text = tweet["extended_tweet"]["full_text"]
-        else:
-            text = tweet["text"]
 
-        single_tweet_data = [
-            {
-                "twitter_id": tweet["id"],
-                "username": tweet["user"]["screen_name"],
-                "text": text,
-                "created_at": tweet["created_at"],
-                "verified_user": tweet["user"]["verified"],
-                "followers": tweet["user"]["followers_count"],
-                "sentiment": twitter_interface.get_tweet_sentiment(text),
-            }
-        ]
+def create_consumer(
+    fetch_min_bytes: int = FETCH_MIN_BYTES,
+    fetch_max_wait_ms: int = FETCH_MAX_WAIT_MS,
+    fetch_max_bytes: int = FETCH_MAX_BYTES,
+    max_partition_fetch_bytes: int = MAX_PARTITION_FETCH_BYTES,
+    max_poll_records: int = MAX_POLL_RECORDS,
+) -> KafkaConsumer:
+    """Returns a KafkaConsumer in the CONSUMER_GROUP_ID group subscribed to TOPIC_NAME.
+    Offsets are committed manually once a batch has been written to the stream DB.
+    Message values are left as raw bytes and decoded once by decode_tweet."""
 
-        print(f"CONSUMER: {single_tweet_data}\n")
+    return KafkaConsumer(
+        TOPIC_NAME,
+        bootstrap_servers=["kafka:9093"],
+        group_id=CONSUMER_GROUP_ID,
+        auto_offset_reset="latest",
+        enable_auto_commit=False,
+        fetch_min_bytes=fetch_min_bytes,
+        fetch_max_wait_ms=fetch_max_wait_ms,
+        fetch_max_bytes=fetch_max_bytes,
+        max_partition_fetch_bytes=max_partition_fetch_bytes,
+        max_poll_records=max_poll_records,
+    )
 
+
+def get_json_loads(backend: str = JSON_BACKEND) -> Callable[[bytes], Dict]:
+    """Returns a loads function accepting bytes for backend ("orjson", "ujson", "json" or "auto")."""
+
+    if backend in ("auto", "orjson"):
+        try:
+            import orjson
+
+            return orjson.loads
+        except ImportError:
+            if backend == "orjson":
+                raise
+
+    if backend in ("auto", "ujson"):
+        try:
+            import ujson
+
+            return ujson.loads
+        except ImportError:
+            if backend == "ujson":
+                raise
+
+    return json.loads
+
+
+class TweetBatch:
+    """Buffer of parsed tweets. Flushed to the stream DB in a single upsert
+    once max_rows tweets are buffered or max_ms milliseconds have elapsed.
+    Upserts run on a writer thread, one batch at a time, so the next batch is consumed and scored
+    while the previous one is written."""
+
+    def __init__(
+        self,
+        max_rows: int = BATCH_MAX_ROWS,
+        max_ms: int = BATCH_MAX_MS,
+        sentiment_workers: int = None,
+    ):
+        self.max_rows = max_rows
+        self.max_ms = max_ms
+        self.sentiment_workers = sentiment_workers
+        self.rows = []
+        self.started_at = time.monotonic()
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tweet-batch-writer"
+        )
+        self.write_future = None
+
+    def add(self, row: Dict) -> None:
+        """Adds a parsed tweet to the buffer."""
+
+        if not self.rows:
+            self.started_at = time.monotonic()
+        self.rows.append(row)
+
+    def is_due(self) -> bool:
+        """Returns True if the buffer has hit its row or time limit."""
+
+        if not self.rows:
+            return False
+        elapsed_ms = (time.monotonic() - self.started_at) * 1000
+        return len(self.rows) >= self.max_rows or elapsed_ms >= self.max_ms
+
+    def remaining_ms(self) -> int:
+        """Milliseconds left before the time limit is reached."""
+
+        if not self.rows:
+            return self.max_ms
+        elapsed_ms = (time.monotonic() - self.started_at) * 1000
+        return max(0, int(self.max_ms - elapsed_ms))
+
+    def flush(self) -> None:
+        """Scores sentiment polarity for all buffered tweets in one parallel batch, waits for the previous
+        batch's upsert, then starts upserting these tweets on the writer thread and empties the buffer.
+        When flush returns, every batch but this one is in the stream DB."""
+
+        if self.rows:
+            polarities = twitter_interface.get_tweets_polarity(
+                [row["text"] for row in self.rows], workers=self.sentiment_workers
+            )
+            for row, polarity in zip(self.rows, polarities):
+                row["sentiment"] = twitter_interface.get_polarity_sentiment(polarity)
+                row["polarity"] = polarity
+
+        self.wait()
+
+        if self.rows:
+            self.write_future = self.writer.submit(self.write, self.rows)
+            self.rows = []
+
+    def write(self, rows: List[Dict]) -> None:
+        """Upserts scored tweets into the tweet_stream table, updating the per-minute sentiment counters.
+        Runs on the writer thread."""
+
+        with db_interface.DBConnection(
+            config.get_stream_creds()
+        ).managed_cursor() as curr:
+            db_interface.execute_tweet_stream_upsert(json_data=rows, curr=curr)
+
+        print(
+            f"CONSUMER: flushed {len(rows)} tweets, "
+            f"sentiment cache {twitter_interface.SENTIMENT_CACHE.stats()}\n"
+        )
+
+    def is_writing(self) -> bool:
+        """Returns True while a batch is being upserted."""
+
+        return self.write_future is not None and not self.write_future.done()
+
+    def wait(self) -> None:
+        """Blocks until the batch being upserted (if any) is in the stream DB. A failed upsert is
+        re-raised on every call, so its offsets are never committed."""
+
+        if self.write_future is not None:
+            self.write_future.result()
+            self.write_future = None
+
+    def close(self) -> None:
+        """Stops the writer thread once the batch being upserted (if any) is done."""
+
+        self.writer.shutdown()
+
+
+def decode_tweet(
+    value: bytes, json_loads: Callable[[bytes], Dict], keywords: List[str]
+) -> List[Dict]:
+    """Parses a payload exactly once and projects it onto the columns of the tweet_stream table,
+    one row per tracked keyword the tweet matched. Accepts both compact records and raw tweet JSON.
+    Returns an empty list for malformed payloads, non-tweet messages and retweets."""
+
+    try:
+        if tweet_schema.is_compact(value):
+            return parse_compact_tweet(tweet_schema.decode_compact(value), keywords)
+        tweet = json_loads(value)
+    except (ValueError, struct.error):
+        return []
+
+    if not isinstance(tweet, dict) or "id" not in tweet or "text" not in tweet:
+        return []
+
+    return parse_tweet(tweet, keywords)
+
+
+def parse_tweet(tweet: Dict, keywords: List[str]) -> List[Dict]:
+    """Projects a raw tweet onto the columns of the tweet_stream table, one row per matched keyword.
+    Sentiment is left unset and scored per batch on flush. Returns an empty list for retweets."""
+
+    if tweet.get("retweeted") or "RT @" in tweet["text"]:
+        return []
+
+    text = tweet_schema.get_full_text(tweet)
+    matched = twitter_interface.match_keywords(
+        tweet_schema.get_match_text(tweet), keywords
+    )
+
+    return [
+        {
+            "twitter_id": tweet["id"],
+            "keyword": keyword,
+            "username": tweet["user"]["screen_name"],
+            "text": text,
+            "created_at": tweet["created_at"],
+            "verified_user": tweet["user"]["verified"],
+            "followers": tweet["user"]["followers_count"],
+            "sentiment": None,
+            "polarity": None,
+        }
+        for keyword in matched
+    ]
+
+
+def parse_compact_tweet(tweet: Dict, keywords: List[str]) -> List[Dict]:
+    """Projects a decoded compact record onto the columns of the tweet_stream table. Records carry
+    their matched keyword (older records without one carry only the text, so keywords are matched against that).
+    Sentiment is left unset and scored per batch on flush. Returns an empty list for retweets."""
+
+    if tweet["retweeted"] or "RT @" in tweet["text"]:
+        return []
+
+    if tweet["keyword"]:
+        matched = [tweet["keyword"]]
+    else:
+        matched = twitter_interface.match_keywords(tweet["text"], keywords)
+
+    return [
+        {
+            "twitter_id": tweet["id"],
+            "keyword": keyword,
+            "username": tweet["screen_name"],
+            "text": tweet["text"],
+            "created_at": tweet["created_at"],
+            "verified_user": tweet["verified"],
+            "followers": tweet["followers_count"],
+            "sentiment": None,
+            "polarity": None,
+        }
+        for keyword in matched
+    ]
+
+
+def handle_sigterm(signum: int, frame) -> None:
+    """Turns SIGTERM (docker stop, Process.terminate) into SystemExit, so the consumer's finally block
+    flushes the batch, commits its offsets and saves the sentiment cache before exiting."""
+
+    raise SystemExit(0)
+
+
+def maintain_partitions() -> None:
+    """Creates upcoming tweet_stream partitions and applies the retention window. Errors are logged,
+    not raised, so a failed maintenance run does not stop consumption (the default partition catches rows)."""
+
+    try:
         with db_interface.DBConnection(
             config.get_stream_creds()
         ).managed_cursor() as curr:
-            db_interface.execute_json_upsert(
-                json_data=single_tweet_data,
-                constraint_key="twitter_id",
-                table_name="tweet_stream",
-                curr=curr,
+            db_interface.maintain_tweet_stream_partitions(curr)
+    except Exception as error:
+        print(f"CONSUMER: partition maintenance failed: {error}\n")
+
+
+def stream_tweets_consume(
+    max_rows: int = BATCH_MAX_ROWS,
+    max_ms: int = BATCH_MAX_MS,
+    sentiment_workers: int = None,
+    json_backend: str = JSON_BACKEND,
+) -> None:
+    """Consumer for the TWEET_STREAM Kafka topic. Loads consumed tweets into the stream DB in micro-batches.
+    Once a batch has been written, exactly the offsets of the messages added to it are committed, so messages
+    polled but not yet written are replayed by the group if a worker crashes.
+    tweet_stream partitions are maintained on start and every PARTITION_MAINTENANCE_INTERVAL_SECONDS.
+    SIGTERM exits cleanly via handle_sigterm, and the sentiment cache is also saved every SENTIMENT_CACHE_SAVE_INTERVAL_SECONDS."""
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    consumer = create_consumer()
+    json_loads = get_json_loads(json_backend)
+    keywords = [symbol.keyword for symbol in config.get_tracked_symbols()]
+    batch = TweetBatch(
+        max_rows=max_rows, max_ms=max_ms, sentiment_workers=sentiment_workers
+    )
+    twitter_interface.configure_sentiment_cache(path=SENTIMENT_CACHE_PATH)
+
+    # Offset of the last message added to the buffered batch, and to the batch being written, per TopicPartition.
+    offsets = {}
+    writing_offsets = {}
+
+    def commit_written() -> None:
+        if writing_offsets:
+            consumer.commit(
+                {
+                    tp: OffsetAndMetadata(offset + 1, None)
+                    for tp, offset in writing_offsets.items()
+                }
             )
+            writing_offsets.clear()
+
+    def flush_and_commit() -> None:
+        # flush returns once the previous batch is written, then starts writing this one.
+        batch.flush()
+        commit_written()
+        writing_offsets.update(offsets)
+        offsets.clear()
+
+    maintain_partitions()
+    last_maintenance = time.monotonic()
+    last_cache_save = time.monotonic()
+
+    try:
+        while True:
+            if (
+                time.monotonic() - last_maintenance
+                >= PARTITION_MAINTENANCE_INTERVAL_SECONDS
+            ):
+                maintain_partitions()
+                last_maintenance = time.monotonic()
+
+            if (
+                time.monotonic() - last_cache_save
+                >= SENTIMENT_CACHE_SAVE_INTERVAL_SECONDS
+            ):
+                twitter_interface.SENTIMENT_CACHE.save()
+                last_cache_save = time.monotonic()
+
+            records = consumer.poll(timeout_ms=batch.remaining_ms())
+
+            for tp, messages in records.items():
+                for message in messages:
+                    for single_tweet_data in decode_tweet(
+                        message.value, json_loads, keywords
+                    ):
+                        batch.add(single_tweet_data)
+                    offsets[tp] = message.offset
+                    if batch.is_due():
+                        flush_and_commit()
+
+            if batch.is_due() or (records and not batch.rows):
+                flush_and_commit()
+            if not batch.is_writing():
+                batch.wait()
+                commit_written()
+    finally:
+        # A second SIGTERM must not interrupt the final flush.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            flush_and_commit()
+            batch.wait()
+            commit_written()
+        finally:
+            batch.close()
+            consumer.close()
+            db_interface.close_all_pools()
+            twitter_interface.shutdown_sentiment_pool()
+            twitter_interface.SENTIMENT_CACHE.save()
+
+
+def stream_tweets_consume_workers(
+    workers: int,
+    max_rows: int = BATCH_MAX_ROWS,
+    max_ms: int = BATCH_MAX_MS,
+    json_backend: str = JSON_BACKEND,
+) -> None:
+    """Runs workers consumer processes in the same consumer group. Kafka balances the
+    topic's partitions across them, so workers should not exceed the partition count.
+    CPU cores are split evenly between the workers' sentiment scoring pools. On SIGTERM, workers are
+    terminated in turn and waited for, so each one flushes its batch before the parent exits.
+    Workers only stop on error, so if any worker exits the others are stopped too and the parent exits
+    non-zero, letting the container's restart policy bring the whole group back."""
+
+    if workers <= 1:
+        stream_tweets_consume(
+            max_rows=max_rows, max_ms=max_ms, json_backend=json_backend
+        )
+        return
+
+    sentiment_workers = max(1, (os.cpu_count() or 1) // workers)
+    processes = [
+        multiprocessing.Process(
+            target=stream_tweets_consume,
+            kwargs={
+                "max_rows": max_rows,
+                "max_ms": max_ms,
+                "sentiment_workers": sentiment_workers,
+                "json_backend": json_backend,
+            },
+            name=f"consumer-{i}",
+        )
+        for i in range(workers)
+    ]
+
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        exited = multiprocessing.connection.wait(
+            [process.sentinel for process in processes]
+        )
+        for process in processes:
+            if process.sentinel in exited:
+                process.join()
+                print(
+                    f"CONSUMER: {process.name} exited with code {process.exitcode}, "
+                    "stopping the other workers\n"
+                )
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+    raise SystemExit(1)
 
 
 if __name__ == "__main__":
-    stream_tweets_consume()
+    parser = argparse.ArgumentParser(description=stream_tweets_consume.__doc__)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of consumer processes in the consumer group (one per partition).",
+    )
+    parser.add_argument("--batch-rows", type=int, default=BATCH_MAX_ROWS)
+    parser.add_argument("--batch-ms", type=int, default=BATCH_MAX_MS)
+    parser.add_argument(
+        "--json-backend",
+        choices=["auto", "orjson", "ujson", "json"],
+        default=JSON_BACKEND,
+    )
+    args = parser.parse_args()
+
+    stream_tweets_consume_workers(
+        workers=args.workers,
+        max_rows=args.batch_rows,
+        max_ms=args.batch_ms,
+        json_backend=args.json_backend,
+    )
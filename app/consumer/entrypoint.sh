@@ -1,5 +1,4 @@
 #!/bin/sh
 
-python consumer.py
-
-exec "$@"
\ No newline at end of file
+# exec so the consumer runs as PID 1 and receives docker stop's SIGTERM.
+exec python consumer.py --workers "${CONSUMER_WORKERS:-1}"
\ No newline at end of file
@@ -1,84 +1,502 @@
+import argparse
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, List
+
 from utils import config, db_interface
 
 
-def init_stock_data_table() -> None:
-    """Initialize stock and stock_price tables in the batch DB."""
+@dataclass
+class Migration:
+    """Object to store a versioned schema migration. Each migration is applied at most once per DB.
+    Optional before/after functions run with the migration's cursor, inside its transaction."""
+
+    version: int
+    description: str
+    query: str
+    before: Callable[[Any], None] = None
+    after: Callable[[Any], None] = None
+
+
+# Advisory lock key held while migrations run, so concurrent runs apply each migration once.
+MIGRATION_LOCK_KEY = 2022
+
+# Tables created before tweets were tracked per keyword only ever held this keyword's tweets.
+LEGACY_KEYWORD = "uranium"
+
+QUERY_CREATE_SENTIMENT_LABEL = """
+    DO $$
+    BEGIN
+        CREATE TYPE sentiment_label AS ENUM ('negative', 'neutral', 'positive');
+    EXCEPTION
+        WHEN duplicate_object THEN NULL;
+    END;
+    $$;
+    """
+
+BATCH_MIGRATIONS = [
+    Migration(
+        version=1,
+        description="Create stock, stock_price, tweet (list-partitioned by keyword) and tweet_sentiment_daily tables",
+        query="""
+            CREATE TABLE IF NOT EXISTS stock(
+                ticker TEXT,
+                name TEXT,
+                PRIMARY KEY(ticker)
+            );
+
+            CREATE TABLE IF NOT EXISTS stock_price(
+                ticker TEXT NOT NULL,
+                timestamp TIMESTAMP NOT NULL,
+                price NUMERIC(5,2),
+                PRIMARY KEY(ticker, timestamp),
+                CONSTRAINT fk_stock
+                    FOREIGN KEY(ticker)
+                    REFERENCES stock(ticker)
+            );
+
+            CREATE TABLE IF NOT EXISTS tweet(
+                id SERIAL,
+                twitter_id BIGSERIAL,
+                keyword TEXT NOT NULL,
+                username TEXT,
+                text TEXT,
+                created_at TIMESTAMP,
+                sentiment TEXT,
+                PRIMARY KEY(id, keyword),
+                UNIQUE(twitter_id, keyword)
+            ) PARTITION BY LIST(keyword);
+
+            CREATE TABLE IF NOT EXISTS tweet_sentiment_daily(
+                day DATE NOT NULL,
+                keyword TEXT NOT NULL,
+                negative INTEGER NOT NULL DEFAULT 0,
+                neutral INTEGER NOT NULL DEFAULT 0,
+                positive INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY(day, keyword)
+            );
+            """,
+        before=lambda curr: rename_legacy_table("tweet", "l", curr),
+        after=lambda curr: adopt_legacy_batch_tables(curr),
+    ),
+    # Dashboard and rollup queries read one keyword partition ordered or ranged by created_at.
+    # stock_price queries (WHERE ticker ORDER BY timestamp DESC) are already served by its primary key.
+    Migration(
+        version=2,
+        description="Index tweet on created_at DESC, covering sentiment",
+        query="""
+            CREATE INDEX IF NOT EXISTS tweet_created_at_idx
+                ON tweet(created_at DESC) INCLUDE (sentiment);
+            """,
+    ),
+    # Compact storage: sentiment as a 4 byte enum (string comparisons in queries keep working) plus the
+    # polarity score, twitter_id as the primary key instead of a surrogate SERIAL and a BIGSERIAL sequence,
+    # and float8 prices, which neither overflow NUMERIC(5,2) nor need arbitrary precision arithmetic.
+    # Rows written before this migration keep a NULL polarity.
+    Migration(
+        version=3,
+        description="Compact tweet and stock_price column types",
+        query=f"""
+            {QUERY_CREATE_SENTIMENT_LABEL}
+
+            ALTER TABLE tweet ALTER COLUMN sentiment TYPE sentiment_label
+                USING sentiment::sentiment_label;
+            ALTER TABLE tweet ADD COLUMN IF NOT EXISTS polarity REAL;
+
+            ALTER TABLE tweet DROP CONSTRAINT IF EXISTS tweet_pkey;
+            ALTER TABLE tweet DROP COLUMN IF EXISTS id;
+            ALTER TABLE tweet ALTER COLUMN twitter_id DROP DEFAULT;
+            DROP SEQUENCE IF EXISTS tweet_twitter_id_seq;
+            ALTER TABLE tweet DROP CONSTRAINT IF EXISTS tweet_twitter_id_keyword_key;
+            ALTER TABLE tweet ADD PRIMARY KEY(twitter_id, keyword);
+
+            ALTER TABLE stock_price ALTER COLUMN price TYPE DOUBLE PRECISION;
+            """,
+    ),
+]
+
+STREAM_MIGRATIONS = [
+    Migration(
+        version=1,
+        description="Create tweet_stream (range-partitioned by day, then by keyword) with its NOTIFY trigger, "
+        "and tweet_stream_sentiment_minute counters",
+        query="""
+            CREATE TABLE IF NOT EXISTS tweet_stream(
+                id SERIAL,
+                twitter_id BIGSERIAL,
+                keyword TEXT NOT NULL,
+                username TEXT,
+                text TEXT,
+                created_at TIMESTAMP NOT NULL,
+                verified_user BOOLEAN,
+                followers INTEGER,
+                sentiment TEXT,
+                PRIMARY KEY(id, created_at, keyword),
+                UNIQUE(twitter_id, created_at, keyword)
+            ) PARTITION BY RANGE(created_at);
 
-    query_delete_stock_stock_price = """
-        DROP TABLE IF EXISTS stock, stock_price;
+            -- Catches tweets outside the premade daily partitions (e.g. consumed long after they were created).
+            CREATE TABLE IF NOT EXISTS tweet_stream_default PARTITION OF tweet_stream DEFAULT;
+
+            -- Statement-level trigger, so a batched upsert sends one NOTIFY carrying its highest id.
+            CREATE OR REPLACE FUNCTION notify_tweet_stream() RETURNS TRIGGER AS $$
+            DECLARE
+                max_id INTEGER;
+            BEGIN
+                SELECT MAX(id) INTO max_id FROM new_rows;
+                IF max_id IS NOT NULL THEN
+                    PERFORM pg_notify('tweet_stream', max_id::TEXT);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS tweet_stream_notify ON tweet_stream;
+            CREATE TRIGGER tweet_stream_notify
+                AFTER INSERT ON tweet_stream
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT
+                EXECUTE FUNCTION notify_tweet_stream();
+
+            CREATE TABLE IF NOT EXISTS tweet_stream_sentiment_minute(
+                minute TIMESTAMP NOT NULL,
+                keyword TEXT NOT NULL,
+                negative INTEGER NOT NULL DEFAULT 0,
+                neutral INTEGER NOT NULL DEFAULT 0,
+                positive INTEGER NOT NULL DEFAULT 0,
+                verified INTEGER NOT NULL DEFAULT 0,
+                non_verified INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY(minute, keyword)
+            );
+            """,
+        before=lambda curr: prepare_legacy_stream_tables(curr),
+        after=lambda curr: adopt_legacy_stream_tables(curr),
+    ),
+    # The dashboard pages through verified and non-verified tweets ORDER BY created_at DESC, id DESC.
+    # Counts and sentiment come from tweet_stream_sentiment_minute, so nothing filters tweet_stream on sentiment.
+    Migration(
+        version=2,
+        description="Partial indexes on tweet_stream for verified and non-verified users by created_at DESC",
+        query="""
+            CREATE INDEX IF NOT EXISTS tweet_stream_verified_created_at_idx
+                ON tweet_stream(created_at DESC, id DESC) WHERE verified_user;
+
+            CREATE INDEX IF NOT EXISTS tweet_stream_non_verified_created_at_idx
+                ON tweet_stream(created_at DESC, id DESC) WHERE NOT verified_user;
+            """,
+    ),
+    # Same compact sentiment and twitter_id types as the batch DB. tweet_stream keeps its SERIAL id,
+    # which is the insertion order watermark the dashboard refreshes from.
+    Migration(
+        version=3,
+        description="Compact tweet_stream column types",
+        query=f"""
+            {QUERY_CREATE_SENTIMENT_LABEL}
+
+            ALTER TABLE tweet_stream ALTER COLUMN sentiment TYPE sentiment_label
+                USING sentiment::sentiment_label;
+            ALTER TABLE tweet_stream ADD COLUMN IF NOT EXISTS polarity REAL;
+
+            ALTER TABLE tweet_stream ALTER COLUMN twitter_id DROP DEFAULT;
+            DROP SEQUENCE IF EXISTS tweet_stream_twitter_id_seq;
+            """,
+    ),
+]
+
+
+def apply_migrations(migrations: List[Migration], curr: Any) -> List[int]:
+    """Applies migrations not yet recorded in the schema_migrations table of curr's DB in version order,
+    each in its own transaction. Already applied migrations are skipped, so re-running is safe.
+    Returns the versions applied."""
+
+    query_create_schema_migrations = """
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INTEGER NOT NULL,
+            description TEXT,
+            applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'UTC'),
+            PRIMARY KEY(version)
+            );
         """
-    query_create_stock = """
-        CREATE TABLE stock(
-            ticker TEXT,
-            name TEXT,
-            PRIMARY KEY(ticker)
-        );
+    query_insert_schema_migration = """
+        INSERT INTO schema_migrations(version, description) VALUES(%s, %s);
         """
-    query_create_stock_price = """
-        CREATE TABLE stock_price(
-            ticker TEXT NOT NULL,
-            timestamp TIMESTAMP NOT NULL,
-            price NUMERIC(5,2),
-            PRIMARY KEY(ticker, timestamp),
-            CONSTRAINT fk_stock
-                FOREIGN KEY(ticker)
-                REFERENCES stock(ticker)
 
-            );
+    curr.execute(query_create_schema_migrations)
+    curr.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+    try:
+        curr.execute("SELECT version FROM schema_migrations;")
+        applied_versions = {row[0] for row in curr.fetchall()}
+
+        applied = []
+        for migration in sorted(migrations, key=lambda x: x.version):
+            if migration.version in applied_versions:
+                continue
+
+            curr.execute("BEGIN;")
+            try:
+                if migration.before is not None:
+                    migration.before(curr)
+                curr.execute(migration.query)
+                if migration.after is not None:
+                    migration.after(curr)
+                curr.execute(
+                    query_insert_schema_migration,
+                    (migration.version, migration.description),
+                )
+                curr.execute("COMMIT;")
+            except Exception:
+                curr.execute("ROLLBACK;")
+                raise
+
+            print(f"Applied migration {migration.version}: {migration.description}")
+            applied.append(migration.version)
+    finally:
+        curr.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+
+    return applied
+
+
+def rename_legacy_table(
+    table_name: str, partition_strategy: str, curr: Any
+) -> bool:
+    """If table_name exists but is not partitioned with partition_strategy ("l" list, "r" range), renames it,
+    its primary key, serial sequences and any partitions with a _legacy suffix, freeing the names for the
+    partitioned table. Returns True if a legacy table was renamed."""
+
+    curr.execute(
         """
-    with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
-        curr.execute(query_delete_stock_stock_price)
-        curr.execute(query_create_stock)
-        curr.execute(query_create_stock_price)
+        SELECT pg_partitioned_table.partstrat
+        FROM pg_class
+        LEFT JOIN pg_partitioned_table ON pg_partitioned_table.partrelid = pg_class.oid
+        WHERE pg_class.oid = to_regclass(%s);
+        """,
+        (table_name,),
+    )
+    row = curr.fetchone()
+    if row is None or row[0] == partition_strategy:
+        return False
+
+    curr.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass;
+        """,
+        (table_name,),
+    )
+    for (partition_name,) in curr.fetchall():
+        curr.execute(
+            f"ALTER TABLE {partition_name} RENAME TO {partition_name}_legacy;"
+        )
+
+    curr.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_legacy;")
+    curr.execute(
+        f"ALTER INDEX IF EXISTS {table_name}_pkey RENAME TO {table_name}_legacy_pkey;"
+    )
+    for column in ("id", "twitter_id"):
+        curr.execute(
+            f"ALTER SEQUENCE IF EXISTS {table_name}_{column}_seq "
+            f"RENAME TO {table_name}_legacy_{column}_seq;"
+        )
+
+    return True
+
+
+def has_column(table_name: str, column: str, curr: Any) -> bool:
+    """Returns True if table_name has column."""
 
+    curr.execute(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s;",
+        (table_name, column),
+    )
+    return curr.fetchone() is not None
 
-def init_twitter_data_table() -> None:
-    """Initialize tweet table in the batch DB."""
 
-    query_delete_tweet = """
-        DROP TABLE IF EXISTS tweet;
+def copy_legacy_rows(
+    table_name: str,
+    columns: List[str],
+    curr: Any,
+    where: str = "TRUE",
+    params: tuple = (),
+) -> None:
+    """Copies rows of {table_name}_legacy matching where into table_name, tagging them with LEGACY_KEYWORD
+    if the legacy table predates the keyword column, advances the id sequence past the copied ids and
+    drops the legacy table."""
+
+    legacy_name = f"{table_name}_legacy"
+    if has_column(legacy_name, "keyword", curr):
+        keyword = "keyword"
+    else:
+        keyword = curr.mogrify("%s", (LEGACY_KEYWORD,)).decode("utf-8")
+
+    select_columns = [keyword if column == "keyword" else column for column in columns]
+    curr.execute(
+        f"""
+        INSERT INTO {table_name}({", ".join(columns)})
+        SELECT {", ".join(select_columns)} FROM {legacy_name}
+        WHERE {where}
+        ON CONFLICT DO NOTHING;
+        """,
+        params,
+    )
+    curr.execute(
+        f"""
+        SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), MAX(id))
+        FROM {table_name}
+        HAVING MAX(id) IS NOT NULL;
         """
-    query_create_tweet = """
-        CREATE TABLE tweet(
-            id SERIAL,
-            twitter_id BIGSERIAL UNIQUE,
-            username TEXT,
-            text TEXT,
-            created_at TIMESTAMP,
-            sentiment TEXT,
-            PRIMARY KEY(id)
-            );
+    )
+    curr.execute(f"DROP TABLE {legacy_name};")
+
+
+def adopt_legacy_batch_tables(curr: Any) -> None:
+    """Moves the rows of an unpartitioned (pre keyword) tweet table renamed by rename_legacy_table into
+    the partitioned tweet table, then seeds tweet_sentiment_daily from tweet."""
+
+    curr.execute("SELECT to_regclass('tweet_legacy');")
+    if curr.fetchone()[0] is not None:
+        db_interface.create_keyword_partitions("tweet", curr)
+        copy_legacy_rows(
+            "tweet",
+            [
+                "id",
+                "twitter_id",
+                "keyword",
+                "username",
+                "text",
+                "created_at",
+                "sentiment",
+            ],
+            curr,
+        )
+
+    curr.execute(
         """
-    with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
-        curr.execute(query_delete_tweet)
-        curr.execute(query_create_tweet)
+        INSERT INTO tweet_sentiment_daily(day, keyword, negative, neutral, positive)
+        SELECT created_at::date,
+            keyword,
+            COUNT(*) FILTER (WHERE sentiment = 'negative'),
+            COUNT(*) FILTER (WHERE sentiment = 'neutral'),
+            COUNT(*) FILTER (WHERE sentiment = 'positive')
+        FROM tweet
+        WHERE created_at IS NOT NULL
+        GROUP BY 1, 2
+        ON CONFLICT(day, keyword) DO NOTHING;
+        """
+    )
+
+
+def prepare_legacy_stream_tables(curr: Any) -> None:
+    """Renames a tweet_stream table that is not range partitioned by day out of the way, and adds the keyword
+    column to tweet_stream_sentiment_minute counters created before tweets were tracked per keyword."""
+
+    rename_legacy_table("tweet_stream", "r", curr)
+
+    curr.execute("SELECT to_regclass('tweet_stream_sentiment_minute');")
+    if curr.fetchone()[0] is not None and not has_column(
+        "tweet_stream_sentiment_minute", "keyword", curr
+    ):
+        curr.execute(
+            """
+            ALTER TABLE tweet_stream_sentiment_minute ADD COLUMN keyword TEXT NOT NULL DEFAULT %s;
+            ALTER TABLE tweet_stream_sentiment_minute ALTER COLUMN keyword DROP DEFAULT;
+            ALTER TABLE tweet_stream_sentiment_minute DROP CONSTRAINT tweet_stream_sentiment_minute_pkey;
+            ALTER TABLE tweet_stream_sentiment_minute ADD PRIMARY KEY(minute, keyword);
+            """,
+            (LEGACY_KEYWORD,),
+        )
 
 
-def init_twitter_streaming_table() -> None:
-    """Initialize tweet table in the stream DB."""
+def adopt_legacy_stream_tables(curr: Any) -> None:
+    """Moves the rows of a legacy tweet_stream table renamed by prepare_legacy_stream_tables into the
+    partitioned tweet_stream table, creating the daily partitions they need, then seeds the
+    tweet_stream_sentiment_minute counters from them. Rows already outside the retention window
+    (db_interface.TWEET_STREAM_RETENTION_DAYS) are not copied, as they would be dropped."""
 
-    query_delete_tweet_stream = """
-        DROP TABLE IF EXISTS tweet_stream;
+    curr.execute("SELECT to_regclass('tweet_stream_legacy');")
+    if curr.fetchone()[0] is None:
+        return
+
+    cutoff_day = datetime.utcnow().date() - timedelta(
+        days=db_interface.TWEET_STREAM_RETENTION_DAYS
+    )
+    curr.execute(
+        "SELECT MAX(created_at) FROM tweet_stream_legacy WHERE created_at >= %s;",
+        (cutoff_day,),
+    )
+    last_created_at = curr.fetchone()[0]
+    if last_created_at is not None:
+        db_interface.create_day_partitions(
+            "tweet_stream",
+            start_day=cutoff_day,
+            days=(last_created_at.date() - cutoff_day).days + 1,
+            curr=curr,
+        )
+
+    copy_legacy_rows(
+        "tweet_stream",
+        [
+            "id",
+            "twitter_id",
+            "keyword",
+            "username",
+            "text",
+            "created_at",
+            "verified_user",
+            "followers",
+            "sentiment",
+        ],
+        curr,
+        where="created_at >= %s",
+        params=(cutoff_day,),
+    )
+
+    # Counters that existed before this migration already hold counts for these rows, so only empty ones are
+    # seeded, grouped the same way as db_interface.execute_tweet_stream_upsert.
+    curr.execute(
         """
-    query_create_tweet_stream = """
-        CREATE TABLE tweet_stream(
-            id SERIAL,
-            twitter_id BIGSERIAL UNIQUE,
-            username TEXT,
-            text TEXT,
-            created_at TIMESTAMP,
-            verified_user BOOLEAN,
-            followers INTEGER,
-            sentiment TEXT,
-            PRIMARY KEY(id)
-            );
+        INSERT INTO tweet_stream_sentiment_minute(
+            minute, keyword, negative, neutral, positive, verified, non_verified
+        )
+        SELECT date_trunc('minute', created_at),
+            keyword,
+            COUNT(*) FILTER (WHERE sentiment = 'negative'),
+            COUNT(*) FILTER (WHERE sentiment = 'neutral'),
+            COUNT(*) FILTER (WHERE sentiment = 'positive'),
+            COUNT(*) FILTER (WHERE verified_user),
+            COUNT(*) FILTER (WHERE NOT verified_user)
+        FROM tweet_stream
+        WHERE NOT EXISTS (SELECT 1 FROM tweet_stream_sentiment_minute)
+        GROUP BY 1, 2;
         """
+    )
+
+
+def migrate_batch_db() -> None:
+    """Brings the batch DB schema up to date and creates tweet partitions for any newly tracked keywords."""
+
+    with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
+        apply_migrations(BATCH_MIGRATIONS, curr)
+        db_interface.create_keyword_partitions("tweet", curr)
+
+
+def migrate_stream_db() -> None:
+    """Brings the stream DB schema up to date and creates the upcoming tweet_stream partitions."""
+
     with db_interface.DBConnection(config.get_stream_creds()).managed_cursor() as curr:
-        curr.execute(query_delete_tweet_stream)
-        curr.execute(query_create_tweet_stream)
+        apply_migrations(STREAM_MIGRATIONS, curr)
+        db_interface.maintain_tweet_stream_partitions(curr)
 
 
 if __name__ == "__main__":
-    # init_stock_data_table()
-    # init_twitter_data_table()
-    init_twitter_streaming_table()
+    parser = argparse.ArgumentParser(
+        description="Apply pending schema migrations. Existing data is never dropped."
+    )
+    parser.add_argument("--db", choices=["batch", "stream", "all"], default="all")
+    args = parser.parse_args()
+
+    if args.db in ("batch", "all"):
+        migrate_batch_db()
+    if args.db in ("stream", "all"):
+        migrate_stream_db()
@@ -1,40 +1,401 @@
+import json
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import BinaryIO, List, Tuple
+
 import tweepy
 from kafka import KafkaProducer
+from kafka.admin import KafkaAdminClient, NewPartitions, NewTopic
+from kafka.errors import TopicAlreadyExistsError
+
+from utils import config, tweet_schema, twitter_interface
+
+BOOTSTRAP_SERVERS = "kafka:9093"
 
-from utils import config
+# Producer batching and compression. linger_ms trades a little latency for fuller batches.
+COMPRESSION_TYPE = "gzip"
+LINGER_MS = 50
+BATCH_SIZE = 64 * 1024
 
-PRODUCER = KafkaProducer(bootstrap_servers="kafka:9093")
+PRODUCER = KafkaProducer(
+    bootstrap_servers=BOOTSTRAP_SERVERS,
+    key_serializer=lambda x: x.encode("utf-8"),
+    compression_type=COMPRESSION_TYPE,
+    linger_ms=LINGER_MS,
+    batch_size=BATCH_SIZE,
+)
 
 TOPIC_NAME = "TWEET_STREAM"
 
-QUERY = "uranium"
+# "compact" sends tweet_schema records, "json" sends the raw Twitter payload.
+WIRE_FORMAT = "compact"
+
+# If enabled, raw payloads are also sent to a separate archive topic.
+ARCHIVE_RAW = False
+ARCHIVE_TOPIC_NAME = "TWEET_STREAM_RAW"
+
+# Upper bound on the number of consumer workers that can share the topic.
+TOPIC_PARTITIONS = 8
+
+
+# Bounded queue between the tweepy stream thread and the Kafka sender thread.
+# QUEUE_FULL_POLICY is one of "block", "drop_oldest" or "spill" (to SPILL_PATH on disk).
+QUEUE_MAX_SIZE = 10000
+QUEUE_FULL_POLICY = "drop_oldest"
+SPILL_PATH = "producer_spill.bin"
+STATS_INTERVAL_SECONDS = 60
+
+# Spilled messages are moved back onto the queue this many at a time, whenever the queue is empty.
+SPILL_REPLAY_BATCH_SIZE = 1000
+
+SPILL_HEADER = struct.Struct(">HHI")
+
+
+class TweetSender:
+    """Decouples the tweepy stream thread from Kafka. Messages are put on a bounded in-memory
+    queue and sent by a background thread, with delivery callbacks updating counters.
+    When the queue is full, policy decides whether to block, drop the oldest message,
+    or spill the new message to disk to be replayed once the queue drains. The spill file is append-only
+    and replayed from a read offset, and is only removed once fully replayed; it is read and written
+    without holding self.cond, so disk I/O never stalls the other thread's queue operations."""
+
+    def __init__(
+        self,
+        max_size: int = QUEUE_MAX_SIZE,
+        policy: str = QUEUE_FULL_POLICY,
+        spill_path: str = SPILL_PATH,
+    ):
+        if policy not in ("block", "drop_oldest", "spill"):
+            raise ValueError(f"Unknown queue full policy: {policy}")
+
+        self.max_size = max_size
+        self.policy = policy
+        self.spill_path = spill_path
+        # Guards the spill file handles and spill_end, the length of the complete messages written so far.
+        self.spill_lock = threading.Lock()
+        self.spill_writer = None
+        self.spill_reader = None
+        self.spill_end = get_spill_length(spill_path)
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.counters = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+        }
+        self.counters_lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self.run, name="tweet-sender", daemon=True
+        )
+        self.thread.start()
+
+    def enqueue(self, topic: str, key: str, value: bytes) -> None:
+        """Queues a message for sending. Called from the tweepy stream thread."""
+
+        with self.cond:
+            if len(self.queue) >= self.max_size:
+                if self.policy == "block":
+                    while len(self.queue) >= self.max_size and not self.closed:
+                        self.cond.wait()
+                elif self.policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.count("dropped")
+
+            spill = self.policy == "spill" and len(self.queue) >= self.max_size
+            if not spill:
+                self.queue.append((topic, key, value))
+                self.count("enqueued")
+                self.cond.notify_all()
+
+        if spill:
+            self.spill(topic, key, value)
+
+    def run(self) -> None:
+        """Sender thread. Drains the queue into the KafkaProducer, replaying spilled messages when idle."""
+
+        last_stats = time.monotonic()
+
+        while True:
+            with self.cond:
+                idle = not self.queue
+            replayed = idle and self.replay_spill()
+
+            with self.cond:
+                if not self.queue and not replayed:
+                    if self.closed:
+                        return
+                    self.cond.wait(timeout=1)
+                message = self.queue.popleft() if self.queue else None
+                self.cond.notify_all()
+
+            if message is not None:
+                self.send(*message)
+
+            if time.monotonic() - last_stats >= STATS_INTERVAL_SECONDS:
+                print(f"PRODUCER: {self.stats()}\n")
+                last_stats = time.monotonic()
+
+    def send(self, topic: str, key: str, value: bytes) -> None:
+        """Sends one message, attaching delivery callbacks."""
+
+        try:
+            future = PRODUCER.send(topic, key=key, value=value)
+        except Exception as error:
+            self.on_send_error(error)
+            return
+
+        future.add_callback(self.on_send_success)
+        future.add_errback(self.on_send_error)
+
+    def on_send_success(self, record_metadata) -> None:
+        """Delivery callback for acknowledged messages."""
+
+        self.count("sent")
+
+    def on_send_error(self, error: Exception) -> None:
+        """Delivery callback for failed messages."""
+
+        self.count("failed")
+        print(f"PRODUCER: delivery failed: {error}\n")
+
+    def spill(self, topic: str, key: str, value: bytes) -> None:
+        """Appends a message to the spill file. Called from the tweepy stream thread without holding self.cond."""
+
+        topic_bytes = topic.encode("utf-8")
+        key_bytes = key.encode("utf-8")
+        record = (
+            SPILL_HEADER.pack(len(topic_bytes), len(key_bytes), len(value))
+            + topic_bytes
+            + key_bytes
+            + value
+        )
+
+        with self.spill_lock:
+            if self.spill_writer is None:
+                self.spill_writer = open(self.spill_path, "ab")
+            self.spill_writer.write(record)
+            self.spill_writer.flush()
+            self.spill_end += len(record)
+        self.count("spilled")
+
+    def replay_spill(self) -> bool:
+        """Reads up to SPILL_REPLAY_BATCH_SIZE spilled messages from the read offset onto the queue, removing the
+        spill file once it is fully replayed. Called from the sender thread without holding self.cond.
+        Returns True if any messages were replayed."""
+
+        with self.spill_lock:
+            end = self.spill_end
+        if not end:
+            return False
+
+        if self.spill_reader is None:
+            self.spill_reader = open(self.spill_path, "rb")
+        messages = read_spill(self.spill_reader, end, SPILL_REPLAY_BATCH_SIZE)
+
+        with self.spill_lock:
+            if self.spill_reader.tell() == self.spill_end:
+                self.close_spill()
+                os.remove(self.spill_path)
+                self.spill_end = 0
+
+        with self.cond:
+            self.queue.extend(messages)
+            self.cond.notify_all()
+
+        return bool(messages)
+
+    def close_spill(self) -> None:
+        """Closes the spill file handles. Caller must hold self.spill_lock."""
+
+        for f in (self.spill_writer, self.spill_reader):
+            if f is not None:
+                f.close()
+        self.spill_writer = None
+        self.spill_reader = None
+
+    def count(self, name: str) -> None:
+        """Increments a counter."""
+
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def stats(self) -> dict:
+        """Returns a copy of the counters and the current queue depth."""
+
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats["queued"] = len(self.queue)
+        return stats
+
+    def close(self) -> None:
+        """Stops the sender thread once the queue and spill file are drained and flushes the KafkaProducer."""
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        with self.spill_lock:
+            self.close_spill()
+        PRODUCER.flush()
+        print(f"PRODUCER: {self.stats()}\n")
+
+
+def read_spill(
+    f: BinaryIO, end: int, max_messages: int
+) -> List[Tuple[str, str, bytes]]:
+    """Reads up to max_messages (topic, key, value) messages from spill file f, starting at its current
+    position and stopping at offset end (the length of the complete messages written so far)."""
+
+    messages = []
+    while len(messages) < max_messages and f.tell() < end:
+        topic_len, key_len, value_len = SPILL_HEADER.unpack(f.read(SPILL_HEADER.size))
+        topic = f.read(topic_len).decode("utf-8")
+        key = f.read(key_len).decode("utf-8")
+        value = f.read(value_len)
+        messages.append((topic, key, value))
+
+    return messages
+
+
+def get_spill_length(path: str) -> int:
+    """Returns the length of the complete messages in a spill file left by a previous run (0 if there is none),
+    truncating a partially written last message so new messages are appended after complete ones."""
+
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        length = 0
+        while length + SPILL_HEADER.size <= size:
+            f.seek(length)
+            topic_len, key_len, value_len = SPILL_HEADER.unpack(
+                f.read(SPILL_HEADER.size)
+            )
+            message_end = (
+                length + SPILL_HEADER.size + topic_len + key_len + value_len
+            )
+            if message_end > size:
+                break
+            length = message_end
+        f.truncate(length)
+
+    return length
 
 
 def stream_tweets_produce() -> None:
     """Producer for the TWEET_STREAM Kafka topic. Listens to TweetStreamListener."""
 
-    while True:
-        twitter_creds = config.get_twitter_creds()
-        stream = TweetStreamListener(
-            twitter_creds.twitter_api_key,
-            twitter_creds.twitter_api_secret,
-            twitter_creds.twitter_access_token,
-            twitter_creds.twitter_access_secret,
-        )
-        stream.filter(track=[QUERY], stall_warnings=True, languages=["en"])
+    create_topic()
+    sender = TweetSender()
+    keywords = [symbol.keyword for symbol in config.get_tracked_symbols()]
+
+    try:
+        while True:
+            twitter_creds = config.get_twitter_creds()
+            stream = TweetStreamListener(
+                twitter_creds.twitter_api_key,
+                twitter_creds.twitter_api_secret,
+                twitter_creds.twitter_access_token,
+                twitter_creds.twitter_access_secret,
+                sender=sender,
+                keywords=keywords,
+            )
+            stream.filter(track=keywords, stall_warnings=True, languages=["en"])
+    finally:
+        sender.close()
 
 
 class TweetStreamListener(tweepy.Stream):
-    """Twitter API to get and filter realtime tweets."""
+    """Twitter API to get and filter realtime tweets. Matching tweets are handed to a TweetSender."""
+
+    def __init__(self, *args, sender: TweetSender, keywords: List[str], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sender = sender
+        self.keywords = keywords
 
     def on_data(self, data):
-        """This is called when raw data is received from the stream. Sends data to the Kafka topic."""
+        """This is called when raw data is received from the stream. Queues original tweets for the Kafka topic,
+        as one compact record per tracked keyword matched (or the raw payload for the "json" wire format).
+        Retweets and non-tweet control messages (limit notices, deletes, warnings) are dropped.
+        Never blocks on Kafka unless the sender's queue full policy is "block"."""
 
-        print(f"PRODUCER: {data}\n")
+        try:
+            tweet = json.loads(data)
+        except ValueError:
+            return True
 
-        PRODUCER.send(TOPIC_NAME, data)
+        if not is_original_tweet(tweet):
+            return True
+
+        if WIRE_FORMAT == "compact":
+            matched = twitter_interface.match_keywords(
+                tweet_schema.get_match_text(tweet), self.keywords
+            )
+            for keyword in matched:
+                value = tweet_schema.encode_compact(tweet, keyword)
+                self.sender.enqueue(TOPIC_NAME, tweet["id_str"], value)
+        else:
+            self.sender.enqueue(TOPIC_NAME, tweet["id_str"], data)
+        if ARCHIVE_RAW:
+            self.sender.enqueue(ARCHIVE_TOPIC_NAME, tweet["id_str"], data)
         return True
 
 
+def is_original_tweet(tweet: dict) -> bool:
+    """Returns True if a decoded payload is a tweet that is not a retweet."""
+
+    if not isinstance(tweet, dict) or "id_str" not in tweet or "text" not in tweet:
+        return False
+
+    if (
+        "retweeted_status" in tweet
+        or tweet.get("retweeted")
+        or "RT @" in tweet["text"]
+    ):
+        return False
+
+    return True
+
+
+def create_topic() -> None:
+    """Creates TOPIC_NAME (and ARCHIVE_TOPIC_NAME if archiving) with TOPIC_PARTITIONS
+    partitions if they do not exist yet. Existing topics with fewer partitions (e.g. auto-created
+    with one) are grown to TOPIC_PARTITIONS."""
+
+    topic_names = [TOPIC_NAME]
+    if ARCHIVE_RAW:
+        topic_names.append(ARCHIVE_TOPIC_NAME)
+
+    admin = KafkaAdminClient(bootstrap_servers=BOOTSTRAP_SERVERS)
+    try:
+        for topic_name in topic_names:
+            try:
+                admin.create_topics(
+                    [
+                        NewTopic(
+                            name=topic_name,
+                            num_partitions=TOPIC_PARTITIONS,
+                            replication_factor=1,
+                        )
+                    ]
+                )
+            except TopicAlreadyExistsError:
+                topic = admin.describe_topics([topic_name])[0]
+                partition_count = len(topic["partitions"])
+                if partition_count < TOPIC_PARTITIONS:
+                    admin.create_partitions(
+                        {topic_name: NewPartitions(total_count=TOPIC_PARTITIONS)}
+                    )
+    finally:
+        admin.close()
+
+
 if __name__ == "__main__":
     stream_tweets_produce()
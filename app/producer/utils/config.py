@@ -77,6 +77,24 @@ def get_twitter_creds() -> TwitterParams:
     return twitter_params
 
 
+@dataclass
+class TrackedSymbol:
+    """Object to store a tracked Twitter keyword and its stock ticker."""
+
+    keyword: str
+    ticker: str
+    name: str
+
+
+def get_tracked_symbols() -> List[TrackedSymbol]:
+    """Returns the Twitter keywords (lowercase) and stock tickers tracked by the producer, lambdas and dashboard.
+    Each keyword gets its own partition of the tweet and tweet_stream tables."""
+
+    return [
+        TrackedSymbol(keyword="uranium", ticker="URA", name="Uranium ETF"),
+    ]
+
+
 def get_ssm_params(names: List[str]) -> List[str]:
     """Returns parameters from the AWS SSM parameter store. Must have AWS credentials configured in .aws file."""
 
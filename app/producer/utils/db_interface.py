@@ -1,5 +1,11 @@
+import io
+import re
+import select
+import threading
+import time
 from contextlib import contextmanager
-from typing import Any, Dict, List
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Tuple
 
 import pandas as pd
 import psycopg2
@@ -8,39 +14,218 @@ import psycopg2.extras as extras
 import utils.config as config
 
 
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 5
+POOL_MAX_AGE_SECONDS = 30 * 60
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# tweet_stream is range partitioned by day on created_at (and each day by keyword).
+# Partitions are created TWEET_STREAM_PREMAKE_DAYS ahead and dropped once older than TWEET_STREAM_RETENTION_DAYS.
+TWEET_STREAM_PREMAKE_DAYS = 3
+TWEET_STREAM_RETENTION_DAYS = 7
+
+# Advisory lock key held while partitions are maintained, so concurrent consumer workers don't race on DDL.
+PARTITION_MAINTENANCE_LOCK_KEY = 2021
+
+
+class ConnectionPool:
+    """Thread-safe pool of open connections to a single DB. Connections are
+    health checked on checkout and recycled once older than max_age seconds."""
+
+    def __init__(
+        self,
+        conn_url: str,
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        max_age: float = POOL_MAX_AGE_SECONDS,
+    ):
+        self.conn_url = conn_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self._idle = []
+        self._created_at = {}
+        self._cond = threading.Condition()
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self) -> Any:
+        """Opens a new autocommit connection and records its creation time."""
+
+        conn = psycopg2.connect(self.conn_url)
+        conn.autocommit = True
+        self._created_at[conn] = time.monotonic()
+        return conn
+
+    def _discard(self, conn: Any) -> None:
+        """Closes a connection and forgets it."""
+
+        self._created_at.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_usable(self, conn: Any) -> bool:
+        """Returns True if the connection is open, young enough, and responds to a ping."""
+
+        if conn.closed:
+            return False
+        if time.monotonic() - self._created_at[conn] > self.max_age:
+            return False
+        try:
+            with conn.cursor() as curr:
+                curr.execute("SELECT 1;")
+        except psycopg2.Error:
+            return False
+        return True
+
+    def get_connection(self) -> Any:
+        """Borrows a connection from the pool. Blocks while max_size connections are checked out."""
+
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._is_usable(conn):
+                        return conn
+                    self._discard(conn)
+                if len(self._created_at) < self.max_size:
+                    return self._connect()
+                self._cond.wait()
+
+    def put_connection(self, conn: Any) -> None:
+        """Returns a borrowed connection to the pool. Broken connections are closed instead."""
+
+        with self._cond:
+            if conn.closed or conn not in self._created_at:
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def close_all(self) -> None:
+        """Closes every idle connection in the pool."""
+
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+
+
+def get_pool(db_params: config.DbParams) -> ConnectionPool:
+    """Returns the process-wide ConnectionPool for db_params, creating it on first use."""
+
+    key = get_conn_url(db_params)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(key)
+        return _POOLS[key]
+
+
+def close_all_pools() -> None:
+    """Closes idle connections in every pool. Call on process shutdown."""
+
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close_all()
+        _POOLS.clear()
+
+
+def get_conn_url(db_params: config.DbParams) -> str:
+    """Builds a postgresql:// connection url from a DbParams object."""
+
+    return (
+        f"postgresql://{db_params.user}:{db_params.password}@"
+        f"{db_params.host}:{db_params.port}/{db_params.db}"
+    )
+
+
 class DBConnection:
-    """Object to handle a connection to a DB. Must pass in a DbParams object when initializing."""
+    """Object to handle a connection to a DB. Must pass in a DbParams object when initializing.
+    Connections are borrowed from, and returned to, a process-wide pool keyed by the DbParams."""
 
     def __init__(self, db_params: config.DbParams):
-        self.conn_url = (
-            f"postgresql://{db_params.user}:{db_params.password}@"
-            f"{db_params.host}:{db_params.port}/{db_params.db}"
-        )
+        self.conn_url = get_conn_url(db_params)
+        self.pool = get_pool(db_params)
 
     @contextmanager
     def managed_cursor(self, cursor_factory=None):
         """Method returns DB cursor."""
-        self.conn = psycopg2.connect(self.conn_url)
-        self.conn.autocommit = True
-        self.curr = self.conn.cursor(cursor_factory=cursor_factory)
+        self.conn = self.pool.get_connection()
         try:
-            yield self.curr
+            self.curr = self.conn.cursor(cursor_factory=cursor_factory)
+            try:
+                yield self.curr
+            finally:
+                self.curr.close()
         finally:
-            self.curr.close()
-            self.conn.close()
+            self.pool.put_connection(self.conn)
+
+
+class DBListener:
+    """Object to LISTEN for notifications on a channel. Holds its own dedicated connection
+    (not pooled, since it stays subscribed). Must pass in a DbParams object and channel name."""
+
+    def __init__(self, db_params: config.DbParams, channel: str):
+        self.conn_url = get_conn_url(db_params)
+        self.channel = channel
+        self.conn = None
+        self.connect()
+
+    def connect(self) -> None:
+        """Opens the connection and subscribes to the channel."""
+
+        self.conn = psycopg2.connect(self.conn_url)
+        self.conn.autocommit = True
+        with self.conn.cursor() as curr:
+            curr.execute(f"LISTEN {self.channel};")
+
+    def wait(self, timeout: float) -> List[str]:
+        """Blocks up to timeout seconds for notifications. Returns their payloads (empty on timeout)."""
+
+        if self.conn.closed:
+            self.connect()
+
+        if select.select([self.conn], [], [], timeout) == ([], [], []):
+            return []
+
+        self.conn.poll()
+        payloads = [notify.payload for notify in self.conn.notifies]
+        self.conn.notifies.clear()
+
+        return payloads
+
+    def close(self) -> None:
+        """Closes the connection."""
+
+        self.conn.close()
 
 
 def execute_df_upsert(
-    df: pd.DataFrame, constraint_key: str, table_name: str, curr: Any
+    df: pd.DataFrame,
+    constraint_key: str,
+    table_name: str,
+    curr: Any,
+    method: str = "values",
 ) -> None:
-    """Upserts a dataframe into table_name belonging to curr's DB. If constraint_key already exists, do nothing."""
+    """Upserts a dataframe into table_name belonging to curr's DB. If constraint_key already exists, do nothing.
+    Method is either "values" (batched INSERTs) or "copy" (COPY into a staging table, then one INSERT)."""
+
+    cols = list(df.columns)
+
+    if method == "copy":
+        rows = df.itertuples(index=False, name=None)
+        execute_copy_upsert(rows, cols, constraint_key, table_name, curr)
+        return
 
     tuples = [tuple(x) for x in df.to_numpy()]
-    cols = ",".join(list(df.columns))
 
     query = "INSERT INTO %s(%s) VALUES %%s ON CONFLICT(%s) DO NOTHING" % (
         table_name,
-        cols,
+        ",".join(cols),
         constraint_key,
     )
 
@@ -48,17 +233,266 @@ def execute_df_upsert(
 
 
 def execute_json_upsert(
-    json_data: List[Dict], constraint_key: str, table_name: str, curr: Any
+    json_data: List[Dict],
+    constraint_key: str,
+    table_name: str,
+    curr: Any,
+    method: str = "values",
 ) -> None:
-    """Upsert a JSON object into table_name belonging to curr's DB. If constraint_key already exists, do nothing."""
+    """Upsert a JSON object into table_name belonging to curr's DB. If constraint_key already exists, do nothing.
+    Method is either "values" (batched INSERTs) or "copy" (COPY into a staging table, then one INSERT)."""
+
+    cols = list(json_data[0].keys())
+
+    if method == "copy":
+        rows = (tuple(x.values()) for x in json_data)
+        execute_copy_upsert(rows, cols, constraint_key, table_name, curr)
+        return
 
     tuples = [tuple(x.values()) for x in json_data]
-    cols = ",".join(json_data[0].keys())
 
     query = "INSERT INTO %s(%s) VALUES %%s ON CONFLICT(%s) DO NOTHING" % (
         table_name,
-        cols,
+        ",".join(cols),
         constraint_key,
     )
 
     extras.execute_values(curr, query, tuples)
+
+
+def execute_copy_upsert(
+    rows: Iterable[Tuple],
+    cols: List[str],
+    constraint_key: str,
+    table_name: str,
+    curr: Any,
+) -> None:
+    """Streams rows into a temporary staging table using COPY FROM STDIN, then upserts them
+    into table_name with a single INSERT ... SELECT. If constraint_key already exists, do nothing."""
+
+    staging_table = f"{table_name}_staging"
+    col_list = ",".join(cols)
+
+    curr.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    curr.execute(
+        f"CREATE TEMP TABLE {staging_table} AS SELECT {col_list} FROM {table_name} WITH NO DATA;"
+    )
+    try:
+        curr.copy_expert(
+            f"COPY {staging_table}({col_list}) FROM STDIN", CopyRowStream(rows)
+        )
+        curr.execute(
+            f"INSERT INTO {table_name}({col_list}) SELECT {col_list} FROM {staging_table} "
+            f"ON CONFLICT({constraint_key}) DO NOTHING;"
+        )
+    finally:
+        curr.execute(f"DROP TABLE IF EXISTS {staging_table};")
+
+
+class CopyRowStream(io.TextIOBase):
+    """File-like object that lazily encodes rows in COPY text format, so COPY FROM STDIN
+    can read them in chunks without materializing the whole payload."""
+
+    def __init__(self, rows: Iterable[Tuple]):
+        self.rows = iter(rows)
+        self.buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += "\t".join(format_copy_value(x) for x in row) + "\n"
+
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def format_copy_value(value: Any) -> str:
+    """Formats a single value for COPY text format. None and NaN become NULL."""
+
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def refresh_tweet_sentiment_daily(
+    keyword: str, start_day: str, end_day: str, curr: Any
+) -> None:
+    """Recomputes tweet_sentiment_daily rows for keyword between start_day and end_day (inclusive)
+    from the tweet table belonging to curr's DB. Only the touched days are rescanned."""
+
+    query = """
+        INSERT INTO tweet_sentiment_daily(day, keyword, negative, neutral, positive)
+        SELECT created_at::date AS day,
+            %(keyword)s AS keyword,
+            COUNT(*) FILTER (WHERE sentiment = 'negative'),
+            COUNT(*) FILTER (WHERE sentiment = 'neutral'),
+            COUNT(*) FILTER (WHERE sentiment = 'positive')
+        FROM tweet
+        WHERE keyword = %(keyword)s
+            AND created_at >= %(start_day)s::date
+            AND created_at < %(end_day)s::date + 1
+        GROUP BY 1
+        ON CONFLICT(day, keyword) DO UPDATE SET
+            negative = EXCLUDED.negative,
+            neutral = EXCLUDED.neutral,
+            positive = EXCLUDED.positive;
+        """
+
+    curr.execute(
+        query, {"keyword": keyword, "start_day": start_day, "end_day": end_day}
+    )
+
+
+def execute_tweet_stream_upsert(json_data: List[Dict], curr: Any) -> None:
+    """Upserts tweets into the tweet_stream table belonging to curr's DB and adds the tweets that were
+    actually inserted to the tweet_stream_sentiment_minute counters, in a single statement.
+    Tweets whose (twitter_id, created_at, keyword) already exists are skipped and not counted twice."""
+
+    cols = list(json_data[0].keys())
+    tuples = [tuple(x.values()) for x in json_data]
+
+    query = """
+        WITH inserted AS (
+            INSERT INTO tweet_stream(%s) VALUES %%s
+            ON CONFLICT(twitter_id, created_at, keyword) DO NOTHING
+            RETURNING created_at, keyword, sentiment, verified_user
+        )
+        INSERT INTO tweet_stream_sentiment_minute(
+            minute, keyword, negative, neutral, positive, verified, non_verified
+        )
+        SELECT date_trunc('minute', created_at),
+            keyword,
+            COUNT(*) FILTER (WHERE sentiment = 'negative'),
+            COUNT(*) FILTER (WHERE sentiment = 'neutral'),
+            COUNT(*) FILTER (WHERE sentiment = 'positive'),
+            COUNT(*) FILTER (WHERE verified_user),
+            COUNT(*) FILTER (WHERE NOT verified_user)
+        FROM inserted
+        GROUP BY 1, 2
+        ON CONFLICT(minute, keyword) DO UPDATE SET
+            negative = tweet_stream_sentiment_minute.negative + EXCLUDED.negative,
+            neutral = tweet_stream_sentiment_minute.neutral + EXCLUDED.neutral,
+            positive = tweet_stream_sentiment_minute.positive + EXCLUDED.positive,
+            verified = tweet_stream_sentiment_minute.verified + EXCLUDED.verified,
+            non_verified = tweet_stream_sentiment_minute.non_verified + EXCLUDED.non_verified;
+        """ % ",".join(cols)
+
+    extras.execute_values(curr, query, tuples, page_size=len(tuples))
+
+
+def create_keyword_partitions(table_name: str, curr: Any) -> None:
+    """Creates one list partition of table_name per tracked keyword, plus a default partition
+    for any other keyword. Safe to re-run after adding keywords to config.get_tracked_symbols."""
+
+    for symbol in config.get_tracked_symbols():
+        partition_name = f"{table_name}_{re.sub('[^0-9a-z]+', '_', symbol.keyword.lower())}"
+        curr.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} FOR VALUES IN (%s);",
+            (symbol.keyword,),
+        )
+    curr.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT;"
+    )
+
+
+def get_day_partition_name(table_name: str, day: date) -> str:
+    """Returns the name of table_name's partition holding rows created on day."""
+
+    return f"{table_name}_p{day:%Y%m%d}"
+
+
+def create_day_partitions(
+    table_name: str, start_day: date, days: int, curr: Any
+) -> None:
+    """Creates daily range partitions of table_name on created_at for days days from start_day,
+    each list partitioned by keyword. Existing partitions are left alone."""
+
+    for offset in range(days):
+        day = start_day + timedelta(days=offset)
+        partition_name = get_day_partition_name(table_name, day)
+        curr.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name}
+            FOR VALUES FROM (%s) TO (%s) PARTITION BY LIST(keyword);
+            """,
+            (day, day + timedelta(days=1)),
+        )
+        create_keyword_partitions(partition_name, curr)
+
+
+def drop_expired_day_partitions(
+    table_name: str, cutoff_day: date, curr: Any
+) -> List[str]:
+    """Drops table_name's daily partitions for days before cutoff_day and deletes expired rows
+    from its default partition. Returns the names of the dropped partitions."""
+
+    curr.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass;
+        """,
+        (table_name,),
+    )
+    pattern = re.compile(rf"^{table_name}_p(\d{{8}})$")
+
+    dropped = []
+    for (partition_name,) in curr.fetchall():
+        match = pattern.match(partition_name)
+        if match and datetime.strptime(match.group(1), "%Y%m%d").date() < cutoff_day:
+            curr.execute(f"DROP TABLE IF EXISTS {partition_name};")
+            dropped.append(partition_name)
+
+    curr.execute(
+        f"DELETE FROM {table_name}_default WHERE created_at < %s;", (cutoff_day,)
+    )
+
+    return dropped
+
+
+def maintain_tweet_stream_partitions(
+    curr: Any,
+    premake_days: int = TWEET_STREAM_PREMAKE_DAYS,
+    retention_days: int = TWEET_STREAM_RETENTION_DAYS,
+) -> None:
+    """Creates tweet_stream partitions from yesterday through premake_days ahead, drops partitions older than
+    retention_days and trims the tweet_stream_sentiment_minute counters to the same window.
+    Skipped if another process is already maintaining the partitions."""
+
+    curr.execute(
+        "SELECT pg_try_advisory_lock(%s);", (PARTITION_MAINTENANCE_LOCK_KEY,)
+    )
+    if not curr.fetchone()[0]:
+        return
+
+    try:
+        today = datetime.utcnow().date()
+        cutoff_day = today - timedelta(days=retention_days)
+        create_day_partitions(
+            "tweet_stream", today - timedelta(days=1), premake_days + 2, curr
+        )
+        dropped = drop_expired_day_partitions("tweet_stream", cutoff_day, curr)
+        curr.execute(
+            "DELETE FROM tweet_stream_sentiment_minute WHERE minute < %s;",
+            (cutoff_day,),
+        )
+        if dropped:
+            print(f"DB: dropped expired partitions {', '.join(dropped)}\n")
+    finally:
+        curr.execute(
+            "SELECT pg_advisory_unlock(%s);", (PARTITION_MAINTENANCE_LOCK_KEY,)
+        )
@@ -1,56 +1,382 @@
+import io
+import threading
 import time
 import warnings
+from dataclasses import dataclass
+from typing import Any, Dict, List
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.csv as pv
 from plotly.subplots import make_subplots
 
 import streamlit as st
 from utils import config, db_interface
 
 
-def get_stream_tweet_data() -> pd.DataFrame:
-    """Fetches data from the tweet_stream table in the stream DB."""
+SENTIMENT_TYPES = ["negative", "neutral", "positive"]
+
+# Source of daily batch sentiment: "rollup" reads the tweet_sentiment_daily table,
+# "sql" aggregates the tweet table in the batch DB, "python" fetches every tweet.
+BATCH_SENTIMENT_SOURCE = "rollup"
+
+# Page size choices for the verified and non-verified stream tweet tables.
+STREAM_PAGE_SIZES = [25, 50, 100, 250]
+STREAM_DEFAULT_PAGE_SIZE = 50
+
+# The shared stream snapshot is rebuilt when tweet_stream NOTIFYs new rows, waiting
+# STREAM_DEBOUNCE_SECONDS to coalesce bursts, and at least every STREAM_MAX_IDLE_SECONDS.
+# Sessions rerun whenever a new snapshot is published.
+STREAM_NOTIFY_CHANNEL = "tweet_stream"
+STREAM_DEBOUNCE_SECONDS = 0.5
+STREAM_MAX_IDLE_SECONDS = 5 * 60
+
+# Sessions wait for a new snapshot in slices of this length. Streamlit only acts on a widget-triggered
+# rerun at the next st.* call, so a long single wait would make widget changes hang until new tweets arrive.
+STREAM_WAIT_SLICE_SECONDS = 1
+
+# tweet_stream ids are assigned at insert, not commit, so concurrent consumer workers can commit lower ids
+# after higher ones. Each refresh re-checks this many ids below the watermark for rows not yet seen
+# (comfortably above workers x BATCH_MAX_ROWS ids in flight).
+STREAM_WATERMARK_LOOKBACK_IDS = 10000
+
+# Newest tweets kept in memory per table. Pages beyond this are queried from the stream DB.
+STREAM_SNAPSHOT_ROWS = 1000
+
+# Column expressions for Arrow-typed reads. NULLs are coalesced so integer and boolean
+# columns keep their compact dtypes instead of widening to float/object.
+STREAM_SELECT = {
+    "id": "id",
+    "twitter_id": "twitter_id",
+    "created_at": "created_at",
+    "username": "username",
+    "verified_user": "COALESCE(verified_user, FALSE) AS verified_user",
+    "followers": "COALESCE(followers, 0) AS followers",
+    "sentiment": "sentiment",
+    "text": "text",
+}
+
+STREAM_ARROW_TYPES = {
+    "id": pa.int64(),
+    "twitter_id": pa.int64(),
+    "created_at": pa.timestamp("us"),
+    "username": pa.dictionary(pa.int32(), pa.string()),
+    "verified_user": pa.bool_(),
+    "followers": pa.int32(),
+    "sentiment": pa.dictionary(pa.int32(), pa.string()),
+    "text": pa.string(),
+}
+
+# Minutes of per-minute sentiment shown in the live sparkline.
+STREAM_SPARKLINE_MINUTES = 60
+
+# Plotted series are downsampled to the points the chart can actually show. Streamlit does not
+# report the rendered width, so CHART_WIDTH_PX approximates the default centered layout.
+CHART_WIDTH_PX = 700
+CHART_PX_PER_LINE_POINT = 2
+CHART_PX_PER_BAR = 6
+
+STREAM_DISPLAY_COLUMNS = ["created_at", "username", "followers", "sentiment", "text"]
+
+STREAM_COUNT_KEYS = [
+    "total",
+    "negative",
+    "neutral",
+    "positive",
+    "verified",
+    "non_verified",
+]
+
+STREAM_COLUMNS = [
+    "id",
+    "twitter_id",
+    "created_at",
+    "username",
+    "verified_user",
+    "followers",
+    "sentiment",
+    "text",
+]
+
+
+@dataclass(frozen=True)
+class StreamSnapshot:
+    """Read-only view of the tweet_stream table shared by all sessions.
+    Tweets holds the newest STREAM_SNAPSHOT_ROWS verified and non-verified tweets."""
+
+    version: int
+    counts: Dict[str, int]
+    sentiment_minutes: pd.DataFrame
+    tweets: pd.DataFrame
+
+
+class StreamSnapshotRefresher:
+    """Builds one StreamSnapshot per tracked keyword and Streamlit server process in a background thread,
+    so DB load is independent of the number of viewers. Refreshes when tweet_stream NOTIFYs new rows
+    (debounced) or every STREAM_MAX_IDLE_SECONDS. New tweets are fetched incrementally
+    above the highest id seen so far (the watermark), less a lookback window for late commits,
+    skipping ids already seen. At most STREAM_SNAPSHOT_ROWS tweets are fetched per verified_user value;
+    when a fetch is capped, older unseen ids of that value can no longer make the snapshot and are skipped."""
+
+    def __init__(self, keyword: str):
+        self.keyword = keyword
+        self.snapshot = StreamSnapshot(
+            version=0,
+            counts={key: 0 for key in STREAM_COUNT_KEYS},
+            sentiment_minutes=pd.DataFrame(columns=SENTIMENT_TYPES),
+            tweets=pd.DataFrame(columns=STREAM_COLUMNS),
+        )
+        self.watermark = 0
+        self.seen_ids = set()
+        self.floors = {True: 0, False: 0}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run,
+            name=f"stream-snapshot-refresher-{keyword}",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def run(self) -> None:
+        """Refresher thread. Waits on tweet_stream notifications and rebuilds the snapshot."""
+
+        listener = None
+        while True:
+            try:
+                if listener is None:
+                    listener = db_interface.DBListener(
+                        config.get_stream_creds(), STREAM_NOTIFY_CHANNEL
+                    )
+                    self.refresh()
+
+                if listener.wait(STREAM_MAX_IDLE_SECONDS):
+                    deadline = time.monotonic() + STREAM_DEBOUNCE_SECONDS
+                    while time.monotonic() < deadline:
+                        listener.wait(max(0, deadline - time.monotonic()))
+                self.refresh()
+            except Exception as error:
+                print(f"STREAMLIT: snapshot refresh failed: {error}")
+                if listener is not None:
+                    listener.close()
+                    listener = None
+                time.sleep(STREAM_DEBOUNCE_SECONDS)
+
+    def refresh(self) -> None:
+        """Fetches counts, recent per-minute sentiment and tweets above the watermark, then publishes a new snapshot."""
+
+        counts = get_stream_tweet_counts(self.keyword)
+        sentiment_minutes = get_stream_sentiment_minutes(self.keyword)
+        floors = {
+            verified_user: max(floor, self.watermark - STREAM_WATERMARK_LOOKBACK_IDS)
+            for verified_user, floor in self.floors.items()
+        }
+        self.seen_ids = {x for x in self.seen_ids if x > min(floors.values())}
+        new_tweets = get_stream_tweet_data(self.keyword, floors, sorted(self.seen_ids))
+
+        tweets = self.snapshot.tweets
+        if not new_tweets.empty:
+            self.watermark = max(self.watermark, int(new_tweets["id"].max()))
+            self.seen_ids.update(new_tweets["id"].tolist())
+            for verified_user, ids in new_tweets.groupby("verified_user")["id"]:
+                if len(ids) >= STREAM_SNAPSHOT_ROWS:
+                    self.floors[bool(verified_user)] = int(ids.min())
+            if tweets.empty:
+                tweets = new_tweets
+            else:
+                tweets = compact_stream_tweets(
+                    pd.concat([new_tweets, tweets], ignore_index=True).drop_duplicates(
+                        "id"
+                    )
+                )
+            tweets = (
+                tweets.sort_values(["created_at", "id"], ascending=False)
+                .groupby("verified_user", observed=True)
+                .head(STREAM_SNAPSHOT_ROWS)
+                .reset_index(drop=True)
+            )
+
+        with self.cond:
+            self.snapshot = StreamSnapshot(
+                version=self.snapshot.version + 1,
+                counts=counts,
+                sentiment_minutes=sentiment_minutes,
+                tweets=tweets,
+            )
+            self.cond.notify_all()
+
+    def wait_for_update(self, version: int, timeout: float) -> StreamSnapshot:
+        """Blocks until a snapshot newer than version is published, or timeout seconds pass."""
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.snapshot.version != version, timeout)
+            return self.snapshot
+
+
+@st.cache(allow_output_mutation=True)
+def get_stream_snapshot_refresher(keyword: str) -> StreamSnapshotRefresher:
+    """Returns the StreamSnapshotRefresher for keyword shared by every session in this process."""
+
+    return StreamSnapshotRefresher(keyword)
+
+
+def get_stream_tweet_data(
+    keyword: str,
+    floors: Dict[bool, int],
+    seen_ids: List[int] = (),
+    limit: int = STREAM_SNAPSHOT_ROWS,
+) -> pd.DataFrame:
+    """Fetches the newest limit tweets per verified_user value for keyword from the tweet_stream table in the stream DB,
+    with an id above that value's floor and not in seen_ids. Filtering on keyword restricts the scan to that keyword's partition."""
+
+    query = (
+        f"(SELECT {', '.join(STREAM_SELECT[col] for col in STREAM_COLUMNS)} "
+        "FROM tweet_stream WHERE keyword = %s AND COALESCE(verified_user, FALSE) = %s "
+        "AND id > %s AND id <> ALL(%s::INTEGER[]) ORDER BY id DESC LIMIT %s)"
+    )
+
+    return read_stream_tweets(
+        " UNION ALL ".join(query for _ in floors),
+        tuple(
+            param
+            for verified_user, floor in floors.items()
+            for param in (keyword, verified_user, floor, list(seen_ids), limit)
+        ),
+    )
+
+
+def read_stream_tweets(query: str, params: tuple) -> pd.DataFrame:
+    """Runs query against the stream DB and returns a memory-compact frame.
+    Rows are streamed with COPY ... TO STDOUT as CSV and parsed by Arrow straight into typed
+    columns (categorical username/sentiment, int32 followers, native datetime64 created_at),
+    skipping the per-row Python tuples of fetchall."""
+
+    buffer = io.BytesIO()
+    with db_interface.DBConnection(config.get_stream_creds()).managed_cursor() as curr:
+        curr.copy_expert(
+            f"COPY ({curr.mogrify(query, params).decode('utf-8')}) TO STDOUT WITH CSV HEADER",
+            buffer,
+        )
+    buffer.seek(0)
+
+    table = pv.read_csv(
+        buffer,
+        parse_options=pv.ParseOptions(newlines_in_values=True),
+        convert_options=pv.ConvertOptions(
+            column_types=STREAM_ARROW_TYPES,
+            true_values=["t"],
+            false_values=["f"],
+        ),
+    )
+
+    return table.to_pandas()
+
+
+def compact_stream_tweets(df: pd.DataFrame) -> pd.DataFrame:
+    """Restores categorical dtypes lost when concatenating frames with different categories."""
+
+    return df.astype({"username": "category", "sentiment": "category"})
+
+
+def get_stream_tweet_counts(keyword: str) -> Dict[str, int]:
+    """Totals keyword's per-minute counters in the tweet_stream_sentiment_minute table (maintained by the consumer),
+    so counting costs O(minutes) rather than O(tweets)."""
+
+    with db_interface.DBConnection(config.get_stream_creds()).managed_cursor() as curr:
+        curr.execute(
+            """
+            SELECT COALESCE(SUM(negative + neutral + positive), 0) AS total,
+                COALESCE(SUM(negative), 0) AS negative,
+                COALESCE(SUM(neutral), 0) AS neutral,
+                COALESCE(SUM(positive), 0) AS positive,
+                COALESCE(SUM(verified), 0) AS verified,
+                COALESCE(SUM(non_verified), 0) AS non_verified
+            FROM tweet_stream_sentiment_minute
+            WHERE keyword = %s;
+            """,
+            (keyword,),
+        )
+        data = curr.fetchone()
+        cols = [i[0] for i in curr.description]
+
+    return {col: int(value) for col, value in zip(cols, data)}
+
+
+def get_stream_sentiment_minutes(
+    keyword: str, minutes: int = STREAM_SPARKLINE_MINUTES
+) -> pd.DataFrame:
+    """Fetches keyword's per-minute negative, neutral and positive counts for the last minutes minutes."""
 
     with db_interface.DBConnection(config.get_stream_creds()).managed_cursor() as curr:
         curr.execute(
-            "SELECT twitter_id, created_at, username, verified_user, followers, sentiment, text FROM tweet_stream ORDER BY created_at DESC;"
+            """
+            SELECT minute, negative, neutral, positive
+            FROM tweet_stream_sentiment_minute
+            WHERE keyword = %s
+                AND minute >= date_trunc('minute', now() AT TIME ZONE 'UTC') - %s * INTERVAL '1 minute'
+            ORDER BY minute;
+            """,
+            (keyword, minutes),
         )
         data = curr.fetchall()
         cols = [i[0] for i in curr.description]
 
-    df = pd.DataFrame(data, columns=cols)
-    df["created_at"] = (
-        df["created_at"]
+    return pd.DataFrame(data, columns=cols).set_index("minute")
+
+
+def get_stream_tweet_page(
+    keyword: str, verified_user: bool, page: int, page_size: int
+) -> pd.DataFrame:
+    """Fetches one page (1-indexed) of the newest tweets for keyword in the tweet_stream table
+    for verified or non-verified users."""
+
+    return read_stream_tweets(
+        f"SELECT {', '.join(STREAM_SELECT[col] for col in STREAM_DISPLAY_COLUMNS)} "
+        "FROM tweet_stream WHERE keyword = %s AND verified_user = %s "
+        "ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s",
+        (keyword, verified_user, page_size, (page - 1) * page_size),
+    )
+
+
+def format_created_at(created_at: pd.Series) -> pd.Series:
+    """Converts UTC timestamps to US/Eastern display strings."""
+
+    return (
+        pd.to_datetime(created_at)
         .dt.tz_localize("UTC")
         .dt.tz_convert("US/Eastern")
         .dt.strftime("%Y-%m-%d %H:%M:%S")
     )
 
-    return df
-
 
 @st.cache(ttl=60 * 60, allow_output_mutation=True)
-def get_batch_tweet_data() -> pd.DataFrame:
-    """Fetches data from the tweet table in the batch DB."""
+def get_batch_tweet_data(keyword: str) -> pd.DataFrame:
+    """Fetches data for keyword from the tweet table in the batch DB."""
 
     with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
-        curr.execute("SELECT * FROM tweet ORDER BY created_at DESC;")
+        curr.execute(
+            "SELECT * FROM tweet WHERE keyword = %s ORDER BY created_at DESC;",
+            (keyword,),
+        )
         data = curr.fetchall()
         cols = [i[0] for i in curr.description]
 
     df = pd.DataFrame(data, columns=cols)
-    df = df.set_index(df.id).drop(columns=["id"], axis=1)
+    df = df.set_index(df.twitter_id).drop(columns=["twitter_id"], axis=1)
 
     return df
 
 
 @st.cache(ttl=60 * 60, allow_output_mutation=True)
-def get_batch_stock_data() -> pd.DataFrame:
-    """Fetches data from the stock_price table in the batch DB."""
+def get_batch_stock_data(ticker: str) -> pd.DataFrame:
+    """Fetches data for ticker from the stock_price table in the batch DB."""
 
     with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
-        curr.execute("SELECT * FROM stock_price ORDER BY timestamp DESC;")
+        curr.execute(
+            "SELECT * FROM stock_price WHERE ticker = %s ORDER BY timestamp DESC;",
+            (ticker,),
+        )
         data = curr.fetchall()
         cols = [i[0] for i in curr.description]
 
@@ -59,34 +385,83 @@ def get_batch_stock_data() -> pd.DataFrame:
     return df
 
 
-def aggregate_tweet_sentiment_helper(row: pd.Series, sentiment: str) -> int:
-    """Idea is to get a column for each of negative, neutral, and positive.
-    Each with 1s if the sentiment for that row matches."""
-
-    if row["sentiment"] == sentiment:
-        return 1
-    return 0
-
-
 def aggregate_tweet_sentiment(df: pd.DataFrame) -> pd.DataFrame:
     """Aggregate sentiment on a per day basis. Calculate percentage belonging to
     negative, neutral, and positive sentiment."""
 
-    sentiment_types = ["negative", "neutral", "positive"]
+    day = pd.to_datetime(df["created_at"]).dt.floor("D").rename("created_at")
+    sentiment = pd.Categorical(df["sentiment"], categories=SENTIMENT_TYPES)
+
+    counts = pd.crosstab(day, sentiment, dropna=False)
+    counts["total"] = day.value_counts()
+
+    return get_sentiment_percent(counts)
+
+
+@st.cache(ttl=60 * 60, allow_output_mutation=True)
+def get_batch_tweet_sentiment(keyword: str) -> pd.DataFrame:
+    """Aggregates sentiment for keyword per day inside the batch DB, so only daily counts are fetched.
+    Returns the same frame as aggregate_tweet_sentiment(get_batch_tweet_data(keyword))."""
 
-    for sentiment in sentiment_types:
-        df[sentiment] = df.apply(
-            lambda row: aggregate_tweet_sentiment_helper(row=row, sentiment=sentiment),
-            axis=1,
+    with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
+        curr.execute(
+            """
+            SELECT date_trunc('day', created_at) AS created_at,
+                COUNT(*) FILTER (WHERE sentiment = 'negative') AS negative,
+                COUNT(*) FILTER (WHERE sentiment = 'neutral') AS neutral,
+                COUNT(*) FILTER (WHERE sentiment = 'positive') AS positive,
+                COUNT(*) AS total
+            FROM tweet
+            WHERE keyword = %s
+            GROUP BY 1
+            ORDER BY 1;
+            """,
+            (keyword,),
         )
-    df["total"] = df.apply(lambda row: 1, axis=1)
+        data = curr.fetchall()
+        cols = [i[0] for i in curr.description]
 
-    df = df.set_index("created_at").groupby(pd.Grouper(freq="D")).sum()
+    counts = pd.DataFrame(data, columns=cols).set_index("created_at")
 
-    for sentiment in sentiment_types:
-        df[f"{sentiment}_percent"] = df[sentiment] / df["total"]
+    return get_sentiment_percent(counts)
 
-    df = df[["negative_percent", "neutral_percent", "positive_percent"]]
+
+@st.cache(ttl=60 * 60, allow_output_mutation=True)
+def get_batch_tweet_sentiment_rollup(keyword: str) -> pd.DataFrame:
+    """Reads daily sentiment counts for keyword from the tweet_sentiment_daily rollup table in the batch DB."""
+
+    with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
+        curr.execute(
+            """
+            SELECT day AS created_at, negative, neutral, positive,
+                negative + neutral + positive AS total
+            FROM tweet_sentiment_daily
+            WHERE keyword = %s
+            ORDER BY day;
+            """,
+            (keyword,),
+        )
+        data = curr.fetchall()
+        cols = [i[0] for i in curr.description]
+
+    counts = pd.DataFrame(data, columns=cols).set_index("created_at")
+
+    return get_sentiment_percent(counts)
+
+
+def get_sentiment_percent(counts: pd.DataFrame) -> pd.DataFrame:
+    """Converts per day negative, neutral, positive and total counts into percentages.
+    Days without tweets are filled in with NaN, matching a daily resample."""
+
+    if not counts.empty:
+        counts.index = pd.to_datetime(counts.index)
+        days = pd.date_range(counts.index.min(), counts.index.max(), freq="D")
+        counts = counts.reindex(days, fill_value=0)
+        counts.index.name = "created_at"
+
+    df = pd.DataFrame(index=counts.index)
+    for sentiment in SENTIMENT_TYPES:
+        df[f"{sentiment}_percent"] = counts[sentiment] / counts["total"].replace(0, np.nan)
 
     return df
 
@@ -106,130 +481,282 @@ def combine_stock_sentiment_data(
     return df
 
 
+def downsample_lttb(
+    df: pd.DataFrame, x_col: str, y_col: str, threshold: int
+) -> pd.DataFrame:
+    """Downsamples a line series to at most threshold rows with Largest-Triangle-Three-Buckets,
+    which keeps the first and last points and the visually significant peaks and troughs."""
+
+    n = len(df)
+    if threshold >= n or threshold < 3:
+        return df
+
+    df = df.sort_values(x_col)
+    x = pd.to_numeric(df[x_col]).to_numpy(dtype=float)
+    y = df[y_col].to_numpy(dtype=float)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = [0]
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+
+        prev_x, prev_y = x[indices[-1]], y[indices[-1]]
+        areas = np.abs(
+            (prev_x - next_x) * (y[start:end] - prev_y)
+            - (prev_x - x[start:end]) * (next_y - prev_y)
+        )
+        indices.append(start + int(np.nanargmax(areas)) if len(areas) else start)
+    indices.append(n - 1)
+
+    return df.iloc[indices]
+
+
+def downsample_sentiment(
+    df: pd.DataFrame, x_col: str, max_bars: int
+) -> pd.DataFrame:
+    """Resamples sentiment percentages into equal time buckets (averaging within each bucket)
+    so at most about max_bars bars are drawn."""
+
+    if len(df) <= max_bars:
+        return df
+
+    percent_cols = [f"{sentiment}_percent" for sentiment in SENTIMENT_TYPES]
+    span_days = (df[x_col].max() - df[x_col].min()).days + 1
+    bucket = pd.Timedelta(days=-(-span_days // max_bars))
+
+    return (
+        df.set_index(x_col)[percent_cols]
+        .resample(bucket)
+        .mean()
+        .dropna(how="all")
+        .reset_index()
+    )
+
+
+def get_chart_points(px_per_point: int, width_px: int = CHART_WIDTH_PX) -> int:
+    """Number of points worth drawing across a chart width_px pixels wide."""
+
+    return max(3, width_px // px_per_point)
+
+
+def wait_for_stream_update(
+    refresher: StreamSnapshotRefresher, version: int, placeholder: Any
+) -> StreamSnapshot:
+    """Blocks until refresher publishes a snapshot newer than version, waiting in STREAM_WAIT_SLICE_SECONDS
+    slices and touching placeholder between them so pending widget events interrupt the wait."""
+
+    snapshot = refresher.wait_for_update(version, timeout=STREAM_WAIT_SLICE_SECONDS)
+    while snapshot.version == version:
+        placeholder.empty()
+        snapshot = refresher.wait_for_update(
+            version, timeout=STREAM_WAIT_SLICE_SECONDS
+        )
+
+    return snapshot
+
+
 # Streamlit dashboard starts here.
 
 
+def show_stream_tweet_table(
+    snapshot: StreamSnapshot, keyword: str, verified_user: bool, row_count: int
+) -> None:
+    """Renders one page of the verified or non-verified stream tweets with page size and page controls.
+    Pages covered by the shared snapshot are served from memory, older pages from the stream DB."""
+
+    key = "verified" if verified_user else "non_verified"
+
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox(
+            "Rows per page",
+            STREAM_PAGE_SIZES,
+            index=STREAM_PAGE_SIZES.index(STREAM_DEFAULT_PAGE_SIZE),
+            key=f"{key}_page_size",
+        )
+    with col2:
+        page_count = max(1, -(-row_count // page_size))
+        # The page is seeded and clamped through session_state only, as passing value= as well
+        # makes Streamlit warn that the widget was set through both.
+        if f"{key}_page" not in st.session_state:
+            st.session_state[f"{key}_page"] = 1
+        elif st.session_state[f"{key}_page"] > page_count:
+            st.session_state[f"{key}_page"] = page_count
+        page = st.number_input(
+            f"Page (of {page_count})",
+            min_value=1,
+            max_value=page_count,
+            step=1,
+            key=f"{key}_page",
+        )
+
+    # Select the page by row position so only the page itself is copied out of the snapshot.
+    start = (int(page) - 1) * page_size
+    positions = np.flatnonzero(snapshot.tweets["verified_user"].to_numpy() == verified_user)
+    if start + page_size <= len(positions) or len(positions) >= row_count:
+        page_data = snapshot.tweets[STREAM_DISPLAY_COLUMNS].iloc[
+            positions[start : start + page_size]
+        ]
+    else:
+        page_data = get_stream_tweet_page(
+            keyword=keyword,
+            verified_user=verified_user,
+            page=int(page),
+            page_size=page_size,
+        )
+
+    with st.empty():
+        st.dataframe(
+            page_data.assign(created_at=format_created_at(page_data["created_at"]))
+        )
+
+
 def main():
 
     st.title("Twitter and Stock Price Analysis")
     st.write("#")
 
+    symbols = config.get_tracked_symbols()
     col1, col2 = st.columns(2)
     with col1:
-        st.selectbox("Select Twitter Keyword", ("Uranium",))
+        keyword = st.selectbox(
+            "Select Twitter Keyword",
+            [symbol.keyword for symbol in symbols],
+            format_func=str.title,
+        )
     with col2:
-        st.selectbox("Select Stock Ticker", ("URA",))
+        stock = st.selectbox(
+            "Select Stock Ticker", symbols, format_func=lambda symbol: symbol.ticker
+        )
     st.info(
-        "Currently only configured for Uranium and URA. Next iteration will allow user input."
+        f"Tracking {', '.join(symbol.keyword.title() for symbol in symbols)} "
+        f"and {', '.join(symbol.ticker for symbol in symbols)}."
     )
 
     st.write("#")
     st.header("Live Tweet Stream")
-    st.success("Live data refreshing every 5 seconds.")
+    st.success("Live data refreshing as new tweets arrive.")
 
-    stream_tweet_data = get_stream_tweet_data()
+    refresher = get_stream_snapshot_refresher(keyword)
+    snapshot = refresher.snapshot
+    if snapshot.version == 0:
+        snapshot = wait_for_stream_update(refresher, 0, st.empty())
+    stream_tweet_counts = snapshot.counts
 
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        total_stream_count = stream_tweet_data["twitter_id"].count()
         st.metric(
             "Total Tweet Count",
-            total_stream_count,
+            stream_tweet_counts["total"],
         )
     with col2:
-        negative_stream_count = stream_tweet_data[
-            stream_tweet_data["sentiment"] == "negative"
-        ]["twitter_id"].count()
         st.metric(
             "Negative Tweet Count",
-            negative_stream_count,
+            stream_tweet_counts["negative"],
         )
     with col3:
-        neutral_stream_count = stream_tweet_data[
-            stream_tweet_data["sentiment"] == "neutral"
-        ]["twitter_id"].count()
         st.metric(
             "Neutral Tweet Count",
-            neutral_stream_count,
+            stream_tweet_counts["neutral"],
         )
     with col4:
-        positive_stream_count = stream_tweet_data[
-            stream_tweet_data["sentiment"] == "positive"
-        ]["twitter_id"].count()
         st.metric(
             "Positive Tweet Count",
-            positive_stream_count,
+            stream_tweet_counts["positive"],
         )
 
+    st.write(f"Sentiment per Minute (last {STREAM_SPARKLINE_MINUTES} minutes)")
+    st.line_chart(snapshot.sentiment_minutes[SENTIMENT_TYPES], height=150)
+
     st.write("Verified User Tweets")
-    with st.empty():
-        filtered_stream_tweet_data = stream_tweet_data[
-            stream_tweet_data["verified_user"]
-        ]
-        filtered_stream_tweet_data = filtered_stream_tweet_data[
-            ["created_at", "username", "followers", "sentiment", "text"]
-        ]
-        st.dataframe(filtered_stream_tweet_data)
+    show_stream_tweet_table(
+        snapshot,
+        keyword=keyword,
+        verified_user=True,
+        row_count=stream_tweet_counts["verified"],
+    )
 
     st.write("Non-verified User Tweets")
-    with st.empty():
-        filtered_stream_tweet_data = stream_tweet_data[
-            ~stream_tweet_data["verified_user"]
-        ]
-        filtered_stream_tweet_data = filtered_stream_tweet_data[
-            ["created_at", "username", "followers", "sentiment", "text"]
-        ]
-        st.dataframe(filtered_stream_tweet_data)
+    show_stream_tweet_table(
+        snapshot,
+        keyword=keyword,
+        verified_user=False,
+        row_count=stream_tweet_counts["non_verified"],
+    )
 
-    batch_tweet_data = get_batch_tweet_data()
-    batch_stock_data = get_batch_stock_data()
-    batch_tweet_sentiment = aggregate_tweet_sentiment(batch_tweet_data)
+    batch_stock_data = get_batch_stock_data(stock.ticker)
+    if BATCH_SENTIMENT_SOURCE == "rollup":
+        batch_tweet_sentiment = get_batch_tweet_sentiment_rollup(keyword)
+    elif BATCH_SENTIMENT_SOURCE == "sql":
+        batch_tweet_sentiment = get_batch_tweet_sentiment(keyword)
+    else:
+        batch_tweet_sentiment = aggregate_tweet_sentiment(
+            get_batch_tweet_data(keyword)
+        )
     combined_data = combine_stock_sentiment_data(
         batch_stock_data, batch_tweet_sentiment
     )
 
+    price_data = downsample_lttb(
+        combined_data,
+        x_col="timestamp",
+        y_col="price",
+        threshold=get_chart_points(CHART_PX_PER_LINE_POINT),
+    )
+    sentiment_data = downsample_sentiment(
+        combined_data,
+        x_col="timestamp",
+        max_bars=get_chart_points(CHART_PX_PER_BAR),
+    )
+
     st.write("#")
     st.header("Twitter Sentiment and Stock Price")
     st.info("Data updated every weekday at 5pm EST.")
     fig = make_subplots(rows=2, cols=1)
     fig.append_trace(
         go.Line(
-            x=combined_data["timestamp"],
-            y=combined_data["price"],
-            name="Uranium ETF",
+            x=price_data["timestamp"],
+            y=price_data["price"],
+            name=stock.name,
         ),
         row=1,
         col=1,
     )
     fig.append_trace(
         go.Bar(
-            x=combined_data["timestamp"],
-            y=combined_data["negative_percent"],
+            x=sentiment_data["timestamp"],
+            y=sentiment_data["negative_percent"],
             name="Negative",
             marker_color="red",
-            text=combined_data["negative_percent"],
+            text=sentiment_data["negative_percent"],
         ),
         row=2,
         col=1,
     )
     fig.add_trace(
         go.Bar(
-            x=combined_data["timestamp"],
-            y=combined_data["neutral_percent"],
+            x=sentiment_data["timestamp"],
+            y=sentiment_data["neutral_percent"],
             name="Neutral",
             marker_color="grey",
-            text=combined_data["neutral_percent"],
+            text=sentiment_data["neutral_percent"],
         ),
         row=2,
         col=1,
     )
     fig.add_trace(
         go.Bar(
-            x=combined_data["timestamp"],
-            y=combined_data["positive_percent"],
+            x=sentiment_data["timestamp"],
+            y=sentiment_data["positive_percent"],
             name="Positive",
             marker_color="green",
-            text=combined_data["positive_percent"],
+            text=sentiment_data["positive_percent"],
         ),
         row=2,
         col=1,
@@ -243,7 +770,7 @@ def main():
     )
     st.plotly_chart(fig, use_container_width=True)
 
-    time.sleep(5)
+    wait_for_stream_update(refresher, snapshot.version, st.empty())
     st.experimental_rerun()
 
 
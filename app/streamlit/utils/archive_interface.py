@@ -0,0 +1,325 @@
+import json
+import uuid
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Dict, List
+
+import boto3
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+# Raw tweet archive (data lake). Any pyarrow filesystem URI works, e.g. a local directory as a stand-in for S3.
+ARCHIVE_ROOT = "s3://stock-twitter-s3/raw_tweets"
+ARCHIVE_COMPRESSION = "zstd"
+
+# ParquetArchiveWriter writes a row group each time this many rows are buffered for a day.
+ARCHIVE_ROW_GROUP_SIZE = 5000
+
+# Streaming NDJSON uploads: gzip output is sent to S3 in NDJSON_PART_SIZE multipart parts (S3 minimum 5 MiB)
+# by a background thread, with at most NDJSON_MAX_PARTS_IN_FLIGHT parts buffered for upload.
+NDJSON_PART_SIZE = 8 * 1024 * 1024
+NDJSON_MAX_PARTS_IN_FLIGHT = 2
+
+# Commonly used fields get typed columns. The full tweet is kept in the raw column as JSON.
+ARCHIVE_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("created_at", pa.timestamp("s", tz="UTC")),
+        ("user_id", pa.int64()),
+        ("screen_name", pa.string()),
+        ("verified", pa.bool_()),
+        ("followers_count", pa.int32()),
+        ("text", pa.string()),
+        ("lang", pa.string()),
+        ("retweet_count", pa.int32()),
+        ("favorite_count", pa.int32()),
+        ("in_reply_to_status_id", pa.int64()),
+        ("is_retweet", pa.bool_()),
+        ("raw", pa.string()),
+    ]
+)
+
+# Hive-style partition directories: {root}/keyword={keyword}/date={YYYY-MM-DD}/part-*.parquet
+ARCHIVE_PARTITION_SCHEMA = pa.schema([("keyword", pa.string()), ("date", pa.string())])
+ARCHIVE_PARTITIONING = ds.partitioning(ARCHIVE_PARTITION_SCHEMA, flavor="hive")
+
+
+def parse_created_at(created_at: str) -> datetime:
+    """Parses a Twitter API v1.1 created_at string, e.g. "Wed Oct 10 20:19:24 +0000 2018"."""
+
+    return datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y").astimezone(
+        timezone.utc
+    )
+
+
+def get_archive_text(tweet: Dict) -> str:
+    """Returns the fullest text available in a raw tweet (extended, full_text or compat mode)."""
+
+    if "full_text" in tweet:
+        return tweet["full_text"]
+    if "extended_tweet" in tweet:
+        return tweet["extended_tweet"]["full_text"]
+    return tweet["text"]
+
+
+def to_archive_row(tweet: Dict) -> Dict:
+    """Projects a raw tweet onto the columns of ARCHIVE_SCHEMA."""
+
+    user = tweet.get("user", {})
+
+    return {
+        "id": tweet["id"],
+        "created_at": parse_created_at(tweet["created_at"]),
+        "user_id": user.get("id"),
+        "screen_name": user.get("screen_name"),
+        "verified": user.get("verified"),
+        "followers_count": user.get("followers_count"),
+        "text": get_archive_text(tweet),
+        "lang": tweet.get("lang"),
+        "retweet_count": tweet.get("retweet_count"),
+        "favorite_count": tweet.get("favorite_count"),
+        "in_reply_to_status_id": tweet.get("in_reply_to_status_id"),
+        "is_retweet": "retweeted_status" in tweet,
+        "raw": json.dumps(tweet, separators=(",", ":")),
+    }
+
+
+def write_raw_tweets(
+    raw_tweets: List[Dict],
+    keyword: str,
+    root: str = ARCHIVE_ROOT,
+    compression: str = ARCHIVE_COMPRESSION,
+) -> List[str]:
+    """Writes raw tweets to the archive as compressed Parquet, one new file per created_at day
+    under keyword={keyword}/date={YYYY-MM-DD}. Existing files are never overwritten, so tweets
+    fetched more than once appear more than once (dedupe on id when reading). Returns the paths written."""
+
+    if not raw_tweets:
+        return []
+
+    with ParquetArchiveWriter(keyword, root=root, compression=compression) as writer:
+        for tweet in raw_tweets:
+            writer.write(tweet)
+
+    return writer.paths
+
+
+def read_raw_tweets(
+    columns: List[str] = None,
+    keyword: str = None,
+    start_day: date = None,
+    end_day: date = None,
+    root: str = ARCHIVE_ROOT,
+) -> pa.Table:
+    """Reads archived tweets, optionally only some columns and a keyword and/or inclusive day range.
+    Partition filters skip non-matching directories and only requested columns are decoded."""
+
+    filesystem, base_path = fs.FileSystem.from_uri(root)
+    dataset = ds.dataset(
+        base_path,
+        schema=pa.unify_schemas([ARCHIVE_SCHEMA, ARCHIVE_PARTITION_SCHEMA]),
+        format="parquet",
+        filesystem=filesystem,
+        partitioning=ARCHIVE_PARTITIONING,
+    )
+
+    expression = None
+    for condition in (
+        ds.field("keyword") == keyword if keyword is not None else None,
+        ds.field("date") >= start_day.isoformat() if start_day is not None else None,
+        ds.field("date") <= end_day.isoformat() if end_day is not None else None,
+    ):
+        if condition is not None:
+            expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+class ParquetArchiveWriter:
+    """Streams raw tweets into the archive as they are fetched, in the same layout as write_raw_tweets.
+    Rows are buffered per created_at day and appended to that day's file as a row group every row_group_size
+    rows, so memory stays bounded regardless of the number of tweets. Use as a context manager (or as the
+    raw_tweet_sink of get_tweets via write); files already started are deleted on error."""
+
+    def __init__(
+        self,
+        keyword: str,
+        root: str = ARCHIVE_ROOT,
+        compression: str = ARCHIVE_COMPRESSION,
+        row_group_size: int = ARCHIVE_ROW_GROUP_SIZE,
+    ):
+        self.keyword = keyword
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.filesystem, self.base_path = fs.FileSystem.from_uri(root)
+        self.part_name = (
+            f"part-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"
+        )
+        self.rows_by_day = defaultdict(list)
+        self.writers = {}
+        self.paths = []
+
+    def __enter__(self) -> "ParquetArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, tweet: Dict) -> None:
+        """Adds one raw tweet, writing a row group once row_group_size rows are buffered for its day."""
+
+        row = to_archive_row(tweet)
+        day = row["created_at"].date()
+        self.rows_by_day[day].append(row)
+        if len(self.rows_by_day[day]) >= self.row_group_size:
+            self.write_day(day)
+
+    def write_day(self, day: date) -> None:
+        """Writes the rows buffered for day as a row group, creating the day's file on first use."""
+
+        rows = self.rows_by_day.pop(day)
+        writer = self.writers.get(day)
+        if writer is None:
+            partition_path = (
+                f"{self.base_path}/keyword={self.keyword}/date={day.isoformat()}"
+            )
+            self.filesystem.create_dir(partition_path, recursive=True)
+            path = f"{partition_path}/{self.part_name}"
+            writer = pq.ParquetWriter(
+                path,
+                ARCHIVE_SCHEMA,
+                filesystem=self.filesystem,
+                compression=self.compression,
+            )
+            self.writers[day] = writer
+            self.paths.append(path)
+
+        writer.write_table(pa.Table.from_pylist(rows, schema=ARCHIVE_SCHEMA))
+
+    def close(self) -> None:
+        """Writes the remaining buffered rows and closes every file. paths then lists the files written in day order."""
+
+        for day in sorted(self.rows_by_day):
+            self.write_day(day)
+        for writer in self.writers.values():
+            writer.close()
+        self.paths.sort()
+
+    def abort(self) -> None:
+        """Closes and deletes any files already started, discarding buffered rows."""
+
+        for writer in self.writers.values():
+            writer.close()
+        for path in self.paths:
+            self.filesystem.delete_file(path)
+        self.rows_by_day.clear()
+
+
+class NdjsonS3Writer:
+    """Streams records to an S3 object as gzip-compressed newline-delimited JSON via a multipart upload.
+    Records are compressed as they are written and each full part is uploaded in a background thread
+    while fetching continues, so memory stays bounded by about (max_parts_in_flight + 1) * part_size
+    regardless of the number of records. Use as a context manager; the upload is aborted on error."""
+
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        part_size: int = NDJSON_PART_SIZE,
+        max_parts_in_flight: int = NDJSON_MAX_PARTS_IN_FLIGHT,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_parts_in_flight = max_parts_in_flight
+        self.s3_client = boto3.client("s3")
+        self.compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        self.buffer = bytearray()
+        self.part_number = 0
+        self.pending = deque()
+        self.parts = []
+        self.records = 0
+        self.upload_id = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self) -> "NdjsonS3Writer":
+        self.upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, ContentType="application/gzip"
+        )["UploadId"]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record: Dict) -> None:
+        """Appends one record as a JSON line, uploading a part whenever part_size compressed bytes are buffered."""
+
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self.buffer += self.compressor.compress(line.encode("utf-8"))
+        self.records += 1
+        if len(self.buffer) >= self.part_size:
+            self.upload_buffer()
+
+    def upload_buffer(self) -> None:
+        """Hands the buffered bytes to the upload thread, first waiting for the oldest part if too many are in flight."""
+
+        while len(self.pending) >= self.max_parts_in_flight:
+            self.parts.append(self.pending.popleft().result())
+
+        self.part_number += 1
+        self.pending.append(
+            self.executor.submit(self.upload_part, self.part_number, bytes(self.buffer))
+        )
+        self.buffer = bytearray()
+
+    def upload_part(self, part_number: int, body: bytes) -> Dict:
+        """Uploads one part. Runs on the upload thread."""
+
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def close(self) -> None:
+        """Finishes the gzip stream, uploads the last part and completes the multipart upload.
+        The upload is aborted if any step fails, so no parts are left behind in S3."""
+
+        try:
+            self.buffer += self.compressor.flush()
+            self.upload_buffer()
+            while self.pending:
+                self.parts.append(self.pending.popleft().result())
+            self.executor.shutdown()
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        """Abandons the upload, discarding any parts already sent."""
+
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
@@ -0,0 +1,117 @@
+import struct
+from typing import Dict
+
+# Compact TWEET_STREAM record, version 2:
+#   header  version (uint8), id (int64), flags (uint8), followers_count (uint32),
+#           screen_name length, created_at length, text length (uint16 each),
+#           keyword length (uint8)
+#   body    screen_name, created_at, text, keyword (utf-8)
+# Version 1 records are identical minus the keyword and still decode (keyword None).
+# Raw JSON payloads always start with "{", so the leading version byte tells the two apart.
+COMPACT_VERSION = 2
+COMPACT_HEADERS = {
+    1: struct.Struct(">BqBIHHH"),
+    2: struct.Struct(">BqBIHHHB"),
+}
+
+FLAG_VERIFIED = 0x01
+FLAG_RETWEETED = 0x02
+
+
+def is_compact(payload: bytes) -> bool:
+    """Returns True if payload is a compact record rather than raw tweet JSON."""
+
+    return payload[:1] != b"" and payload[0] in COMPACT_HEADERS
+
+
+def get_full_text(tweet: Dict) -> str:
+    """Returns the untruncated text of a raw tweet."""
+
+    if tweet.get("truncated"):
+        return tweet["extended_tweet"]["full_text"]
+    return tweet["text"]
+
+
+def get_match_text(tweet: Dict) -> str:
+    """Returns the fields of a raw tweet that the Twitter stream matches track keywords against, one per line:
+    the full text, hashtags, mentioned screen names and expanded urls, followed by those of any quoted tweet."""
+
+    entities = tweet.get("entities", {})
+    if tweet.get("truncated"):
+        entities = tweet["extended_tweet"].get("entities", entities)
+
+    fields = [get_full_text(tweet)]
+    fields += [hashtag["text"] for hashtag in entities.get("hashtags", [])]
+    fields += [
+        mention["screen_name"] for mention in entities.get("user_mentions", [])
+    ]
+    fields += [
+        url["expanded_url"] for url in entities.get("urls", []) if url.get("expanded_url")
+    ]
+    if tweet.get("quoted_status"):
+        fields.append(get_match_text(tweet["quoted_status"]))
+
+    return "\n".join(fields)
+
+
+def encode_compact(tweet: Dict, keyword: str) -> bytes:
+    """Encodes the fields of a raw tweet used downstream, plus the tracked keyword it matched,
+    into a compact record."""
+
+    screen_name = tweet["user"]["screen_name"].encode("utf-8")
+    created_at = tweet["created_at"].encode("utf-8")
+    text = get_full_text(tweet).encode("utf-8")
+    keyword_bytes = keyword.encode("utf-8")
+
+    flags = 0
+    if tweet["user"]["verified"]:
+        flags |= FLAG_VERIFIED
+    if tweet.get("retweeted"):
+        flags |= FLAG_RETWEETED
+
+    header = COMPACT_HEADERS[COMPACT_VERSION].pack(
+        COMPACT_VERSION,
+        tweet["id"],
+        flags,
+        tweet["user"]["followers_count"],
+        len(screen_name),
+        len(created_at),
+        len(text),
+        len(keyword_bytes),
+    )
+
+    return header + screen_name + created_at + text + keyword_bytes
+
+
+def decode_compact(payload: bytes) -> Dict:
+    """Decodes a compact record. Returns a dict with id, screen_name, verified,
+    followers_count, text, created_at, retweeted and keyword keys."""
+
+    version = payload[0]
+    if version not in COMPACT_HEADERS:
+        raise ValueError(f"Unsupported compact record version {version}")
+
+    header = COMPACT_HEADERS[version]
+    fields = header.unpack_from(payload)
+    _, tweet_id, flags, followers_count, screen_name_len, created_at_len, text_len = fields[:7]
+    keyword_len = fields[7] if version >= 2 else 0
+
+    offset = header.size
+    screen_name = payload[offset : offset + screen_name_len].decode("utf-8")
+    offset += screen_name_len
+    created_at = payload[offset : offset + created_at_len].decode("utf-8")
+    offset += created_at_len
+    text = payload[offset : offset + text_len].decode("utf-8")
+    offset += text_len
+    keyword = payload[offset : offset + keyword_len].decode("utf-8") or None
+
+    return {
+        "id": tweet_id,
+        "screen_name": screen_name,
+        "verified": bool(flags & FLAG_VERIFIED),
+        "followers_count": followers_count,
+        "text": text,
+        "created_at": created_at,
+        "retweeted": bool(flags & FLAG_RETWEETED),
+        "keyword": keyword,
+    }
@@ -1,12 +1,25 @@
+import hashlib
+import json
+import os
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Tuple
+from typing import Callable, Dict, List, Tuple
 
 import tweepy as tw
 from textblob import TextBlob
 
 import utils.config as config
 
+SENTIMENT_WORKERS = os.cpu_count()
+SENTIMENT_CHUNK_SIZE = 64
+SENTIMENT_CACHE_SIZE = 100000
+
+_SENTIMENT_POOL = None
+_SENTIMENT_POOL_WORKERS = None
+
 
 class TwitterConnection(object):
     """Object to handle a connection to the Twitter API. Must pass in a TwitterParams object when initializing."""
@@ -25,12 +38,20 @@ class TwitterConnection(object):
             print("Error: Auth failed")
 
     def get_tweets(
-        self, query: str, count: int = 1000, until: str = None
+        self,
+        query: str,
+        count: int = 1000,
+        until: str = None,
+        sentiment_workers: int = 1,
+        raw_tweet_sink: Callable[[Dict], None] = None,
     ) -> Tuple[List, List]:
         """Fetches tweets from the Twitter API for a given query.
         Count limits the number of tweets returned.
         Until sets an upper-bound on the created date of tweets returned.
-        Method returns processed tweets and raw tweets."""
+        Processed tweets carry the query as their keyword.
+        Sentiment_workers sets the number of processes used to score sentiment (None for one per core).
+        If raw_tweet_sink is set, each raw tweet is passed to it as it is fetched instead of being collected.
+        Method returns processed tweets and raw tweets (empty when streamed to raw_tweet_sink)."""
 
         tweets_data = []
         raw_tweets = []
@@ -48,10 +69,12 @@ class TwitterConnection(object):
             for tweet in fetched_tweets:
                 single_tweet_data = {
                     "twitter_id": tweet.id,
+                    "keyword": query,
                     "username": tweet.user.name,
                     "text": tweet.text,
                     "created_at": datetime.strftime(tweet.created_at, "%Y%m%d"),
-                    "sentiment": get_tweet_sentiment(tweet.text),
+                    "sentiment": None,
+                    "polarity": None,
                 }
 
                 # If tweet has retweets, ensure it only gets appended once.
@@ -61,7 +84,17 @@ class TwitterConnection(object):
                 else:
                     tweets_data.append(single_tweet_data)
 
-                raw_tweets.append(tweet._json)
+                if raw_tweet_sink is None:
+                    raw_tweets.append(tweet._json)
+                else:
+                    raw_tweet_sink(tweet._json)
+
+            polarities = get_tweets_polarity(
+                [x["text"] for x in tweets_data], workers=sentiment_workers
+            )
+            for single_tweet_data, polarity in zip(tweets_data, polarities):
+                single_tweet_data["sentiment"] = get_polarity_sentiment(polarity)
+                single_tweet_data["polarity"] = polarity
 
             return (tweets_data, raw_tweets)
 
@@ -69,6 +102,17 @@ class TwitterConnection(object):
             print("Error : " + str(error))
 
 
+def match_keywords(text: str, keywords: List[str]) -> List[str]:
+    """Returns the tracked keywords that appear in text as whole words (case-insensitive), however many are tracked.
+    Pass tweet_schema.get_match_text of a raw tweet to match the same fields as the Twitter stream's track filter."""
+
+    return [
+        keyword
+        for keyword in keywords
+        if re.search(rf"(?<!\w){re.escape(keyword)}(?!\w)", text, re.IGNORECASE)
+    ]
+
+
 def clean_tweet(tweet: str) -> str:
     """Utility function to clean tweet text by removing links and special characters using simple regex statements."""
 
@@ -78,13 +122,205 @@ def clean_tweet(tweet: str) -> str:
 
 
 def get_tweet_sentiment(tweet: str) -> str:
-    """Utility function to classify sentiment of passed tweet using textblob's sentiment method."""
+    """Utility function to classify sentiment of passed tweet using textblob's sentiment method.
+    Polarity scores are memoized in SENTIMENT_CACHE, keyed on the cleaned tweet text."""
+
+    text = clean_tweet(tweet)
+    key = SentimentCache.make_key(text)
 
-    analysis = TextBlob(clean_tweet(tweet))
+    polarity = SENTIMENT_CACHE.get(key)
+    if polarity is None:
+        polarity = get_clean_tweet_polarity(text)
+        SENTIMENT_CACHE.put(key, polarity)
 
-    if analysis.sentiment.polarity > 0:
+    return get_polarity_sentiment(polarity)
+
+
+def get_clean_tweet_polarity(text: str) -> float:
+    """Returns textblob's polarity score (-1.0 to 1.0) of already cleaned tweet text. Bypasses the cache."""
+
+    return TextBlob(text).sentiment.polarity
+
+
+def get_polarity_sentiment(polarity: float) -> str:
+    """Classifies a polarity score as negative, neutral or positive."""
+
+    if polarity > 0:
         return "positive"
-    elif analysis.sentiment.polarity == 0:
+    elif polarity == 0:
         return "neutral"
     else:
         return "negative"
+
+
+def get_tweets_sentiment(
+    tweets: List[str],
+    workers: int = SENTIMENT_WORKERS,
+    chunksize: int = SENTIMENT_CHUNK_SIZE,
+) -> List[str]:
+    """Classifies the sentiment of each passed tweet, preserving input order. See get_tweets_polarity."""
+
+    return [
+        get_polarity_sentiment(polarity)
+        for polarity in get_tweets_polarity(
+            tweets, workers=workers, chunksize=chunksize
+        )
+    ]
+
+
+def get_tweets_polarity(
+    tweets: List[str],
+    workers: int = SENTIMENT_WORKERS,
+    chunksize: int = SENTIMENT_CHUNK_SIZE,
+) -> List[float]:
+    """Scores the polarity of each passed tweet, preserving input order.
+    Cached and repeated texts are only scored once. The rest are spread over a process pool
+    of size workers, in chunks of chunksize tweets. Small inputs, or workers == 1,
+    are scored in the calling process."""
+
+    if workers is None:
+        workers = SENTIMENT_WORKERS
+
+    keys = []
+    known = {}
+    misses = {}
+    for tweet in tweets:
+        text = clean_tweet(tweet)
+        key = SentimentCache.make_key(text)
+        keys.append(key)
+        if key in known or key in misses:
+            continue
+        polarity = SENTIMENT_CACHE.get(key)
+        if polarity is None:
+            misses[key] = text
+        else:
+            known[key] = polarity
+
+    if workers <= 1 or len(misses) <= chunksize:
+        polarities = [get_clean_tweet_polarity(text) for text in misses.values()]
+    else:
+        pool = get_sentiment_pool(workers)
+        polarities = pool.map(
+            get_clean_tweet_polarity, misses.values(), chunksize=chunksize
+        )
+
+    for key, polarity in zip(misses.keys(), polarities):
+        SENTIMENT_CACHE.put(key, polarity)
+        known[key] = polarity
+
+    return [known[key] for key in keys]
+
+
+def get_sentiment_pool(workers: int = SENTIMENT_WORKERS) -> ProcessPoolExecutor:
+    """Returns the process-wide sentiment scoring pool, (re)creating it if workers changed."""
+
+    global _SENTIMENT_POOL, _SENTIMENT_POOL_WORKERS
+
+    if _SENTIMENT_POOL is None or _SENTIMENT_POOL_WORKERS != workers:
+        shutdown_sentiment_pool()
+        _SENTIMENT_POOL = ProcessPoolExecutor(max_workers=workers)
+        _SENTIMENT_POOL_WORKERS = workers
+
+    return _SENTIMENT_POOL
+
+
+def shutdown_sentiment_pool() -> None:
+    """Shuts down the sentiment scoring pool, if one was started."""
+
+    global _SENTIMENT_POOL
+
+    if _SENTIMENT_POOL is not None:
+        _SENTIMENT_POOL.shutdown()
+        _SENTIMENT_POOL = None
+
+
+class SentimentCache:
+    """Bounded LRU cache of sentiment polarity scores keyed on a hash of the cleaned tweet text.
+    Tracks hits and misses. If path is set, entries are loaded from and saved to a JSON file."""
+
+    def __init__(self, max_size: int = SENTIMENT_CACHE_SIZE, path: str = None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        """Returns the cache key for cleaned tweet text."""
+
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> float:
+        """Returns the cached polarity for key (None if absent), counting a hit or miss."""
+
+        with self.lock:
+            polarity = self.entries.get(key)
+            if polarity is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return polarity
+
+    def put(self, key: str, polarity: float) -> None:
+        """Stores a polarity score, evicting the least recently used entry when full."""
+
+        with self.lock:
+            self.entries[key] = polarity
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns size, hit and miss counts."""
+
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def load(self) -> None:
+        """Loads entries from path, keeping at most max_size of the most recent.
+        Entries that are not polarity scores (labels saved by older versions) are skipped."""
+
+        with open(self.path) as f:
+            entries = {
+                key: value
+                for key, value in json.load(f).items()
+                if isinstance(value, (int, float))
+            }
+
+        with self.lock:
+            self.entries = OrderedDict(list(entries.items())[-self.max_size :])
+
+    def save(self) -> None:
+        """Writes entries to path, in least to most recently used order."""
+
+        if not self.path:
+            return
+
+        with self.lock:
+            entries = dict(self.entries)
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def configure_sentiment_cache(
+    max_size: int = SENTIMENT_CACHE_SIZE, path: str = None
+) -> SentimentCache:
+    """Replaces the process-wide sentiment cache. Pass path to persist it between restarts."""
+
+    global SENTIMENT_CACHE
+
+    SENTIMENT_CACHE = SentimentCache(max_size=max_size, path=path)
+
+    return SENTIMENT_CACHE
+
+
+SENTIMENT_CACHE = SentimentCache()
@@ -5,10 +5,16 @@ import yfinance as yf
 
 
 def lambda_handler(event, context):
-    """Connect to Yahoo API and fetch stock prices for a given ticker. Stock price written to batch DB."""
+    """Connect to Yahoo API and fetch stock prices for each tracked ticker. Stock prices written to batch DB."""
 
-    ticker = "URA"
-    name = "Uranium ETF"
+    for symbol in config.get_tracked_symbols():
+        load_stock_prices(ticker=symbol.ticker, name=symbol.name)
+
+    return {"Status": "Success!"}
+
+
+def load_stock_prices(ticker: str, name: str) -> None:
+    """Fetch stock prices for a given ticker and write them to the batch DB."""
 
     # Utilize DBConnection to connect to batch DB and insert into the stock table.
     query_insert = f"INSERT INTO stock(ticker, name) VALUES('{ticker}', '{name}') ON CONFLICT(ticker) DO NOTHING;"
@@ -25,8 +31,6 @@ def lambda_handler(event, context):
             curr=curr,
         )
 
-    return {"Status": "Success!"}
-
 
 def get_stock_prices(ticker: str) -> pd.DataFrame:
     """Fetch stock prices from Yahoo finance for a period of 10d and interval of 1d."""
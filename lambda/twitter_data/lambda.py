@@ -1,47 +1,62 @@
-import json
 from datetime import datetime
 
-import boto3
+import archive_interface
 import config
 import db_interface
 import twitter_interface
 
+# Raw tweets are streamed to S3 while they are fetched, keeping memory bounded: "parquet" into the
+# partitioned Parquet archive with archive_interface.ParquetArchiveWriter, "ndjson" to one gzip NDJSON object per day.
+RAW_ARCHIVE_FORMAT = "parquet"
+
 
 def lambda_handler(event, context):
-    """Connect to Twitter API and fetch tweets for given query/keyword string. Processed tweets written to batch DB. Raw tweets stored in S3."""
+    """Connect to Twitter API and fetch tweets for each tracked keyword. Processed tweets written to batch DB. Raw tweets stored in S3."""
 
-    query = "uranium"
     count = 1000
 
-    # Utilize TwitterConnection to connect to Twitter and fetch tweets for query keyword.
+    # Utilize TwitterConnection to connect to Twitter and fetch tweets for each tracked keyword.
     twitter = twitter_interface.TwitterConnection(config.get_twitter_creds())
-    tweets = twitter.get_tweets(query=query, count=count)
+    for symbol in config.get_tracked_symbols():
+        load_tweets(twitter, query=symbol.keyword, count=count)
+
+    return {"Status": "Success!"}
+
+
+def load_tweets(
+    twitter: twitter_interface.TwitterConnection, query: str, count: int
+) -> None:
+    """Fetch tweets for a query/keyword string, write them to the batch DB and store the raw tweets in S3."""
+
+    # Connect to S3 and stream raw tweets as they are fetched.
+    if RAW_ARCHIVE_FORMAT == "ndjson":
+        s3_bucket = "stock-twitter-s3"
+        s3_key = (
+            f"{query}/" + datetime.now().strftime("%Y%m%d") + "_raw_tweets.ndjson.gz"
+        )
+        writer = archive_interface.NdjsonS3Writer(s3_bucket, s3_key)
+    else:
+        writer = archive_interface.ParquetArchiveWriter(keyword=query)
+    with writer:
+        tweets = twitter.get_tweets(
+            query=query, count=count, raw_tweet_sink=writer.write
+        )
     processed_tweets = tweets[0]
-    raw_tweets = tweets[1]
 
-    # Utilize DBConnection to connect to batch DB and upsert processed tweets into the tweet table.
+    # Utilize DBConnection to connect to batch DB and upsert processed tweets into the tweet table and daily rollup.
     with db_interface.DBConnection(config.get_batch_creds()).managed_cursor() as curr:
         db_interface.execute_json_upsert(
             json_data=processed_tweets,
             table_name="tweet",
-            constraint_key="twitter_id",
+            constraint_key="twitter_id, keyword",
             curr=curr,
+            method="copy",
         )
-
-    # Connect to S3 and store raw tweets.
-    s3_bucket = "stock-twitter-s3"
-    s3_key = datetime.now().strftime("%Y%m%d") + "_raw_tweets.json"
-    data = json.dumps(raw_tweets)
-    upload_to_S3(s3_bucket, s3_key, data)
-
-    return {"Status": "Success!"}
-
-
-def upload_to_S3(bucket: str, key: str, data: json) -> None:
-    """Upload data to S3."""
-
-    s3_client = boto3.client("s3")
-    s3_client.put_object(Body=data, Bucket=bucket, Key=key)
+        if processed_tweets:
+            days = [x["created_at"] for x in processed_tweets]
+            db_interface.refresh_tweet_sentiment_daily(
+                keyword=query, start_day=min(days), end_day=max(days), curr=curr
+            )
 
 
 # sam local invoke -e ./twitter_data/lambda_event.json TwitterDataFunction